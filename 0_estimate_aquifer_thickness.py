@@ -12,8 +12,10 @@ from pcraster.framework import *
 import pcraster as pcr
 
 import outputNetCDF
+import background_writer
 import virtualOS as vos
 from monte_carlo_thickness import MonteCarloAquiferThickness
+from ensemble_thickness import EnsembleAquiferThickness
 import margat_correction 
 
 import logging
@@ -33,7 +35,22 @@ clone_map_file = "/scratch/edwin/processing_whymap/version_19september2014/water
 # number_of_samples and option to include_percentile_report
 number_of_samples         = 1000
 number_of_cores           = 10
-include_percentile_report = False
+include_percentile_report = True
+
+# Monte Carlo engine: "numpy" (samples are evaluated in batches, see ensemble_thickness.py) or "pcraster" (MonteCarloFramework)
+monte_carlo_engine        = "numpy"
+batch_size                = 100
+# - sampling of z: "plain" (random sampling), "stratified", "lhs" (Latin hypercube) or "sobol" (see standard_normal.py), 
+#   or, for the "numpy" engine only, "exact" (enumeration of the distinct values in table_from_inge/lookupDepth.txt)
+sampling                  = "exact"
+# - for the "pcraster" engine: report the maps of every sample (required for forked samples);
+#   if False, the statistics are accumulated in memory and the samples are not forked.
+report_sample_maps        = False
+# - seed of the random values (None: a new seed, reported in the log file); the results do not depend on number_of_cores
+random_seed               = 29092014
+# - for the "numpy" engine with random sampling: stop when the relative change of the mean and the relative standard error
+#   (maximum over the cells) are below this tolerance (None: always use number_of_samples)
+tolerance                 = None
 
 # sedimentary basin output file:
 sedimentary_basin_netcdf = {}
@@ -53,6 +70,9 @@ sedimentary_basin_netcdf['attribute']['description']  = "Aquifer/sedimentary bas
 sedimentary_basin_netcdf['attribute']['description'] += "and then corrected based on the reported values from Margat (2003)."
 #
 sedimentary_basin_netcdf['attribute']['comment'    ]  = "Processed and calculated by Edwin H. Sutanudjaja on 29 September 2014."
+#
+# netcdf format, compression and chunking (see outputNetCDF.py); e.g. {'format': 'NETCDF3_CLASSIC'} for the former output
+sedimentary_basin_netcdf['options']                   = {'format': 'NETCDF4', 'zlib': True, 'complevel': 4, 'shuffle': True, 'chunksizes': (256, 256)}
 
 # input files:
 #
@@ -72,6 +92,8 @@ ldd_netcdf['variable_name']            = "lddMap"
 margat_aquifers = {}
 margat_aquifers['shapefile'] = "/scratch/edwin/processing_whymap/version_19september2014/whymap_wgs1984.shp"
 margat_aquifers['txt_table'] = "/scratch/edwin/processing_whymap/version_19september2014/table/margat_table.txt"
+# directory for the rasterized shapefile (keyed by the shapefile content and the clone map); None: no cache 
+margat_aquifers['rasterized_cache'] = "/scratch/edwin/processing_whymap/version_19september2014/rasterized_cache/"
 
 # TODO: include the parameterization of kSat and Sy
 
@@ -104,58 +126,89 @@ def main():
     #
     logger.info('Performing Monte Carlo simulation to estimate aquifer properties !!!')
     #
-    myModel = MonteCarloAquiferThickness(clone_map_file, \
-                                         dem_average_netcdf, dem_floodplain_netcdf, ldd_netcdf, \
-                                         table_thickness, table_zscore, \
-                                         number_of_samples, include_percentile_report)
-
-    dynamic_framework = DynamicFramework(myModel,1)
-    mcModel = MonteCarloFramework(dynamic_framework, nrSamples=number_of_samples)
-    mcModel.setForkSamples(True, nrCPUs=number_of_cores)
-    mcModel.run()
+    if monte_carlo_engine == "numpy":
+        myModel = EnsembleAquiferThickness(clone_map_file, \
+                                           dem_average_netcdf, dem_floodplain_netcdf, ldd_netcdf, \
+                                           table_thickness, table_zscore, \
+                                           number_of_samples, include_percentile_report, \
+                                           batch_size = batch_size, random_seed = random_seed, sampling = sampling, \
+                                           tolerance = tolerance, number_of_cores = number_of_cores)
+        myModel.run()
+    else:
+        myModel = MonteCarloAquiferThickness(clone_map_file, \
+                                             dem_average_netcdf, dem_floodplain_netcdf, ldd_netcdf, \
+                                             table_thickness, table_zscore, \
+                                             number_of_samples, include_percentile_report, \
+                                             report_sample_maps = report_sample_maps, random_seed = random_seed, \
+                                             sampling = sampling)
+
+        dynamic_framework = DynamicFramework(myModel,1)
+        mcModel = MonteCarloFramework(dynamic_framework, nrSamples=number_of_samples)
+        if report_sample_maps: mcModel.setForkSamples(True, nrCPUs=number_of_cores)
+        mcModel.run()
     
     # report average, average variance, standard deviation and percentiles to netcdf files
+    # (written by a background writer, while the thickness is corrected below)
     #
     sedimentary_basin_netcdf['file_name'] = vos.getFullPath(sedimentary_basin_netcdf['file_name'], output_directory)
     logger.info('Reporting topography parameters to a netcdf file: '+sedimentary_basin_netcdf['file_name'])
     #
-    sed_bas_netcdf = outputNetCDF.OutputNetCDF(clone_map_file)
+    sed_bas_netcdf = outputNetCDF.OutputNetCDF(clone_map_file, **sedimentary_basin_netcdf['options'])
+    writer = background_writer.BackgroundWriter()
     #
     variable_names = ["average","average_variance","standard_deviation"]
     units = ["m","m2","m"]
-    pcr.setclone(clone_map_file)
-    variable_fields = [pcr.pcr2numpy(myModel.average           , vos.MV),
-                       pcr.pcr2numpy(myModel.average_variance  , vos.MV),
-                       pcr.pcr2numpy(myModel.standard_deviation, vos.MV)
-                       ]
-    sed_bas_netcdf.createNetCDF(   sedimentary_basin_netcdf['file_name'],variable_names,units)
-    sed_bas_netcdf.changeAtrribute(sedimentary_basin_netcdf['file_name'],sedimentary_basin_netcdf['attribute'])
-    sed_bas_netcdf.data2NetCDF(    sedimentary_basin_netcdf['file_name'],variable_names,variable_fields)
+    percentiles = myModel.percentileList if include_percentile_report else []
+    percentile_names = ["percentile%04d" %(int(percentile*100)) for percentile in percentiles]
     #
-    # reporting percentile values
-    if include_percentile_report:
+    # the writer is always joined (and the session closed), also if the computations below fail
+    try:
+        # all variables (including the corrected thickness, see below) are defined first and written once, in one session
+        writer.submit("open "+sedimentary_basin_netcdf['file_name'], sed_bas_netcdf.openSession, sedimentary_basin_netcdf['file_name'])
+        writer.submit("define variables", sed_bas_netcdf.createNetCDF, sedimentary_basin_netcdf['file_name'], \
+                                          variable_names + percentile_names + ["average_corrected"], \
+                                          units + ["m"] * len(percentile_names) + ["m"])
+        writer.submit("attributes", sed_bas_netcdf.changeAtrribute, sedimentary_basin_netcdf['file_name'], sedimentary_basin_netcdf['attribute'])
         pcr.setclone(clone_map_file)
-        for percentile in myModel.percentileList:
-            variable_name = "percentile%04d" %(int(percentile*100)) ; print(variable_name)
+        variable_fields = [pcr.pcr2numpy(myModel.average           , vos.MV),
+                           pcr.pcr2numpy(myModel.average_variance  , vos.MV),
+                           pcr.pcr2numpy(myModel.standard_deviation, vos.MV)
+                           ]
+        writer.submit(variable_names, sed_bas_netcdf.data2NetCDF, sedimentary_basin_netcdf['file_name'], variable_names, variable_fields)
+        variable_fields = None
+        #
+        # reporting percentile values
+        for percentile, variable_name in zip(percentiles, percentile_names):
             variable_field = pcr.pcr2numpy(myModel.percentiles[percentile], vos.MV)
-            variable_unit = "m"
-            sed_bas_netcdf.addNewVariable(sedimentary_basin_netcdf['file_name'],variable_name,variable_unit)
-            sed_bas_netcdf.data2NetCDF(   sedimentary_basin_netcdf['file_name'],variable_name,variable_field)
-
-    # Correcting or rescaling aquifer thickness map based on Margat's table
-    logger.info("Correcting/rescaling based on the table of Margat and van der Gun")
-    #
-    MargatCorrection = margat_correction.MargatCorrection(clone_map_file,\
-                                                          sedimentary_basin_netcdf['file_name'],\
-                                                          "average",\
-                                                          margat_aquifers,
-                                                          tmp_directory)
-    average_corrected = pcr.pcr2numpy(\
-                        MargatCorrection.aquifer_thickness, vos.MV)
-    #
-    # saving corrected aquifer thickness value to the netcdf file
-    sed_bas_netcdf.addNewVariable(sedimentary_basin_netcdf['file_name'],"average_corrected","m")
-    sed_bas_netcdf.data2NetCDF( sedimentary_basin_netcdf['file_name'],"average_corrected",average_corrected)
+            writer.submit(variable_name, sed_bas_netcdf.data2NetCDF, sedimentary_basin_netcdf['file_name'], variable_name, variable_field)
+        variable_field = None
+        writer.submit("close "+sedimentary_basin_netcdf['file_name'], sed_bas_netcdf.closeSession)
+
+        # Correcting or rescaling aquifer thickness map based on Margat's table 
+        # (using the average map, i.e. without reading the netcdf file that is being written)
+        logger.info("Correcting/rescaling based on the table of Margat and van der Gun")
+        #
+        MargatCorrection = margat_correction.MargatCorrection(clone_map_file,\
+                                                              sedimentary_basin_netcdf['file_name'],\
+                                                              "average",\
+                                                              margat_aquifers,
+                                                              tmp_directory,
+                                                              input_thickness_map = myModel.average)
+        average_corrected = pcr.pcr2numpy(\
+                            MargatCorrection.aquifer_thickness, vos.MV)
+        #
+        # saving corrected aquifer thickness value to the netcdf file (after the tasks above, as the tasks are in order);
+        # the variable is already defined, so the file is not rewritten
+        writer.submit("open "+sedimentary_basin_netcdf['file_name'], sed_bas_netcdf.openSession, sedimentary_basin_netcdf['file_name'], 'a')
+        writer.submit("average_corrected", sed_bas_netcdf.data2NetCDF, sedimentary_basin_netcdf['file_name'], "average_corrected", average_corrected)
+        writer.submit("close "+sedimentary_basin_netcdf['file_name'], sed_bas_netcdf.closeSession)
+    finally:
+        try:
+            writer.join()
+        finally:
+            sed_bas_netcdf.closeSession()
+    
+    logger.info('netcdf handle pool (open files, hits, misses, evictions): '+str(vos.netcdfpool.statistics()))
 
 if __name__ == '__main__':
     sys.exit(main())
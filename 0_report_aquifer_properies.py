@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 
 # Edwin Husni Sutanudjaja (EHS, 29 Sep 2014): This script for reporting aquifer properties 
-#                                             at 5 arc-min and 30 arc-min resolution. 
+#                                             at 5 arc-min and coarser (10, 15, 30 arc-min and 1 degree) resolutions. 
 
 import os
 import sys
@@ -12,9 +12,9 @@ from pcraster.framework import *
 import pcraster as pcr
 
 import outputNetCDF
+import background_writer
+import pyramid_output
 import virtualOS as vos
-from monte_carlo_thickness import MonteCarloAquiferThickness
-import margat_correction 
 
 import logging
 logger = logging.getLogger("main_script") # get name for the logger
@@ -22,8 +22,8 @@ from logger import Logger
 
 # output directory: 
 output_directory      = "/scratch/edwin/aquifer_properties/" 
-output_05min_filename = "/scratch/edwin/aquifer_properties/groundwater_properties_05min.nc"
-output_30min_filename = "/scratch/edwin/aquifer_properties/groundwater_properties_30min.nc"
+# output files, per resolution (in arc minutes)
+output_filename = "/scratch/edwin/aquifer_properties/groundwater_properties_%02dmin.nc"
 cleanOutputDir   = True
 
 # netcdf attributes:
@@ -36,9 +36,19 @@ netcdf_attributes['references' ]  = "None"
 netcdf_attributes['description']  = "None" 
 netcdf_attributes['comment'    ]  = "Processed and calculated by Edwin H. Sutanudjaja (e-mail: E.H.Sutanudjaja@uu.nl" 
 
-# clone/landmask maps at 05 arc min and 30 arc min resolution
+# netcdf format, compression and chunking (see outputNetCDF.py); 
+# - packing: optional packing to int16 (key: variable name, value: (minimum, maximum)), e.g. 
+#   {"thickness": (0.0, 10000.0), "saturated_conductivity": (0.0, 100.0), "specific_yield": (0.0, 1.0)}
+netcdf_options = {'format': 'NETCDF4', 'zlib': True, 'complevel': 4, 'shuffle': True, 'chunksizes': (256, 256), 'packing': None}
+
+# clone/landmask maps: the 05 arc min (input) resolution and the coarser output resolutions; 
+# the coarser resolutions must be multiples of 05 arc min, with the same upper left corner
 clone_map_05min_file = "/scratch/edwin/processing_whymap/version_19september2014/water_polygon/water-polygons-split-4326/landmask_05min.map"
-clone_map_30min_file = "/data/hydroworld/PCRGLOBWB20/input30min/routing/lddsound_30min.map"
+clone_map_files      = [clone_map_05min_file,
+                        "/data/hydroworld/PCRGLOBWB20/input10min/routing/lddsound_10min.map",
+                        "/data/hydroworld/PCRGLOBWB20/input15min/routing/lddsound_15min.map",
+                        "/data/hydroworld/PCRGLOBWB20/input30min/routing/lddsound_30min.map",
+                        "/data/hydroworld/PCRGLOBWB20/input60min/routing/lddsound_60min.map"]
 
 # input file: thickness properties at 30arc min resolution
 thickness_05min_netcdf = {}
@@ -49,10 +59,14 @@ thickness_05min_netcdf['var_name'] = "average_corrected"
 aquifer_properties_05min_netcdf = {}
 aquifer_properties_05min_netcdf['filename'] = "/data/hydroworld/PCRGLOBWB20/input5min/groundwater/groundwaterProperties5ArcMin.nc"
 
-# input file: aquifer properties at 30arc min resolution
-aquifer_properties_30min_netcdf = {}
-aquifer_properties_30min_netcdf['filename'] = "/data/hydroworld/PCRGLOBWB20/input30min/groundwater/groundwaterProperties.nc"
 
+def writeNetCDF(output_netcdf, output_filename, variable_names, units, variable_fields):
+
+    # one writer session (task of the background writer)
+    with output_netcdf.session(output_filename):
+        output_netcdf.createNetCDF(   output_filename,variable_names,units)
+        output_netcdf.changeAtrribute(output_filename,netcdf_attributes)
+        output_netcdf.data2NetCDF(    output_filename,variable_names,variable_fields)
 
 def main():
 
@@ -98,71 +112,49 @@ def main():
                              aquifer_properties_05min_netcdf['filename'],\
                              "specificYield", clone_map_05min_file))
 
-    # saving 5 min parameters to a netcdf file
-    logger.info('Saving groundwater parameter parameters to a netcdf file: '+output_05min_filename)
-    #
-    output_05min_netcdf = outputNetCDF.OutputNetCDF(clone_map_05min_file)
-    #
-    variable_names = ["saturated_conductivity","specific_yield","thickness"]
-    units = ["m/day","1","m"]
-    variable_fields = [
-                       pcr.pcr2numpy(saturated_conductivity, vos.MV),
-                       pcr.pcr2numpy(specific_yield        , vos.MV),
-                       pcr.pcr2numpy(thickness             , vos.MV),
-                       ]
-    pcr.report(saturated_conductivity, "saturated_conductivity_05min.map")
-    pcr.report(specific_yield        , "specific_yield_05min.map")
-    pcr.report(thickness             , "thickness_05min.map")
-    output_05min_netcdf.createNetCDF(   output_05min_filename,variable_names,units)
-    output_05min_netcdf.changeAtrribute(output_05min_filename,netcdf_attributes)
-    output_05min_netcdf.data2NetCDF(    output_05min_filename,variable_names,variable_fields)
-
-    logger.info('Start processing for 30 arc-min resolution!')
-
-    # upscaling thickness to 30 arc min resolution
-    logger.info('Upscaling thickness from 5 arc-min resolution to 30 arc-min!')
-    thickness_05min_array = pcr.pcr2numpy(thickness, vos.MV)
-    thickness_30min_array = vos.regridToCoarse(thickness_05min_array, 30./5.,"average")
-    #
-    # set clone for 30 arc min resolution
-    pcr.setclone(clone_map_30min_file)
-    #
-    landmask  = pcr.defined(clone_map_30min_file)
-    thickness = pcr.ifthen(landmask, 
-                pcr.numpy2pcr(pcr.Scalar, thickness_30min_array, vos.MV))
-    #
-    # update landmask
-    landmask  = pcr.defined(thickness)            
-
-    # read aquifer properties at 30 arc min resolution
-    logger.info('Reading saturated conductivity and specific yield at 30 arc-min resolution!')
-    saturated_conductivity = pcr.ifthen(landmask,\
-                             vos.netcdf2PCRobjCloneWithoutTime(\
-                             aquifer_properties_30min_netcdf['filename'],\
-                             "kSatAquifer"  , clone_map_30min_file))
-    specific_yield         = pcr.ifthen(landmask,\
-                             vos.netcdf2PCRobjCloneWithoutTime(\
-                             aquifer_properties_30min_netcdf['filename'],\
-                             "specificYield", clone_map_30min_file))
-
-    # saving 30 min parameters to a netcdf file
-    logger.info('Saving groundwater parameter parameters to a netcdf file: '+output_30min_filename)
-    #
-    output_30min_netcdf = outputNetCDF.OutputNetCDF(clone_map_30min_file)
-    #
+    # pyramid of all resolutions, from the 5 arc min fields (read once) 
     variable_names = ["saturated_conductivity","specific_yield","thickness"]
     units = ["m/day","1","m"]
-    variable_fields = [
-                       pcr.pcr2numpy(saturated_conductivity, vos.MV),
-                       pcr.pcr2numpy(specific_yield        , vos.MV),
-                       pcr.pcr2numpy(thickness             , vos.MV),
-                       ]
-    pcr.report(saturated_conductivity, "saturated_conductivity_30min.map")
-    pcr.report(specific_yield        , "specific_yield_30min.map")
-    pcr.report(thickness             , "thickness_30min.map")
-    output_30min_netcdf.createNetCDF(   output_30min_filename,variable_names,units)
-    output_30min_netcdf.changeAtrribute(output_30min_filename,netcdf_attributes)
-    output_30min_netcdf.data2NetCDF(    output_30min_filename,variable_names,variable_fields)
+    fine_attributes = vos.getMapAttributesALL(clone_map_05min_file)
+    pyramid = pyramid_output.ResolutionPyramid({"saturated_conductivity": pcr.pcr2numpy(saturated_conductivity, vos.MV),
+                                                "specific_yield"        : pcr.pcr2numpy(specific_yield        , vos.MV),
+                                                "thickness"             : pcr.pcr2numpy(thickness             , vos.MV)},
+                                                fine_attributes['cellsize'])
+    pyramid.build([vos.getMapAttributes(clone_map_file, 'cellsize') for clone_map_file in clone_map_files])
+
+    # saving the parameters of every resolution to a netcdf file and to PCRaster maps (in the background)
+    writer = background_writer.BackgroundWriter()
+    # (the writer is always joined, also if the computations below fail)
+    try:
+        for clone_map_file in clone_map_files:
+        
+            attributes = vos.getMapAttributesALL(clone_map_file)
+            resolution = "%02dmin" %(int(round(attributes['cellsize'] * 60.)))
+            logger.info('Start processing for '+resolution+' resolution!')
+        
+            # clone and landmask
+            pcr.setclone(clone_map_file)
+            landmask = pcr.pcr2numpy(pcr.defined(clone_map_file), 0) == 1
+            thickness = pyramid.average(attributes['cellsize'], "thickness")
+            if thickness.shape != landmask.shape or \
+               abs(attributes['xUL'] - fine_attributes['xUL']) > 1e-6 or abs(attributes['yUL'] - fine_attributes['yUL']) > 1e-6:
+                raise ValueError("The clone map "+clone_map_file+" does not match the aggregated grid of "+clone_map_05min_file)
+            #
+            # update landmask
+            landmask &= thickness != vos.MV
+            variable_fields = [np.where(landmask, pyramid.average(attributes['cellsize'], variable_name), vos.MV) \
+                               for variable_name in variable_names]
+
+            # saving parameters to a netcdf file and PCRaster maps
+            output_filename_resolution = output_filename %(int(round(attributes['cellsize'] * 60.)))
+            logger.info('Saving groundwater parameter parameters to a netcdf file: '+output_filename_resolution)
+            #
+            output_netcdf = outputNetCDF.OutputNetCDF(clone_map_file, **netcdf_options)
+            for variable_name, variable_field in zip(variable_names, variable_fields):
+                writer.report(variable_field, variable_name+"_"+resolution+".map", clone_map_file)
+            writer.submit(output_filename_resolution, writeNetCDF, output_netcdf, output_filename_resolution, variable_names, units, variable_fields)
+    finally:
+        writer.join()
 
 
 if __name__ == '__main__':
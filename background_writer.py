@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Writing output (netCDF and PCRaster files) in a background thread, so that writing overlaps with the computations
+# of the main thread. Output tasks (a function with its arguments, typically NumPy arrays and the target file and
+# variable names) are put in a bounded queue and executed in order (FIFO) by a single writer thread:
+# - the queue is bounded, so that the main thread waits (instead of keeping all fields in memory) if writing is slow,
+# - the arrays of a task must not be modified after submitting it (pass copies, e.g. from pcr.pcr2numpy),
+# - tasks of submit (netCDF output) are executed while holding vos.netcdf_lock, as the netCDF library is not thread
+#   safe; PCRaster maps (report) are written without the lock, so that they do not block netCDF reading,
+# - PCRaster maps are written with GDAL (with the geometry of the clone map given at submitting), as pcr.report
+#   depends on the global clone of the main thread,
+# - after a failed task the remaining tasks are skipped; join() waits for all tasks and raises the error.
+#
+# Usage:
+#   writer = BackgroundWriter()
+#   writer.submit("thickness", output.data2NetCDF, ncFileName, "thickness", thickness_array)
+#   writer.report(thickness_array, "thickness.map", clone_map_file)
+#   ...                                                                      # computations
+#   writer.join()
+
+import time
+import threading
+import traceback
+import numpy as np
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from osgeo import gdal
+
+import logging
+logger = logging.getLogger(__name__)
+
+import virtualOS as vos
+
+def number_of_bytes(arguments):
+
+    # size of the arrays (also in lists and tuples) in the arguments of a task
+    total = 0
+    for argument in arguments:
+        if isinstance(argument, np.ndarray): total += argument.nbytes
+        if isinstance(argument, (list, tuple)): total += number_of_bytes(argument)
+    return total
+
+def writePCRasterMap(values, fileName, cloneMapAttributes):
+
+    # scalar PCRaster map (as pcr.report of pcr.numpy2pcr(pcr.Scalar, values, vos.MV)) with the given geometry
+    rows, cols = values.shape
+    cellsize   = cloneMapAttributes['cellsize']
+    raster = gdal.GetDriverByName("MEM").Create("", cols, rows, 1, gdal.GDT_Float32)
+    raster.SetGeoTransform((cloneMapAttributes['xUL'], cellsize, 0.0, cloneMapAttributes['yUL'], 0.0, - cellsize))
+    band = raster.GetRasterBand(1)
+    # the missing value as float32, as stored in the band
+    band.SetNoDataValue(float(np.float32(vos.MV)))
+    band.WriteArray(np.where(np.isfinite(values), values, vos.MV).astype(np.float32))
+    output = gdal.GetDriverByName("PCRaster").CreateCopy(str(fileName), raster, options = ["PCRASTER_VALUESCALE=VS_SCALAR"])
+    if output is None: raise IOError("Cannot write the PCRaster map "+str(fileName))
+    output.FlushCache()
+
+class BackgroundWriter(object):
+
+    def __init__(self, maxQueueSize = 4):
+
+        object.__init__(self)
+
+        # tasks: (description, lock, function, args, kwargs, number of bytes); None stops the writer thread
+        self.tasks = queue.Queue(maxsize = maxQueueSize)
+
+        # errors: (description, traceback)
+        self.errors = []
+
+        # statistics
+        self.submitted  = 0
+        self.written    = 0
+        self.skipped    = 0
+        self.bytes      = 0
+        self.write_time = 0.0
+        self.max_depth  = 0
+        self.start_time = time.time()
+
+        self.thread = threading.Thread(target = self.run, name = "BackgroundWriter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, description, function, *args, **kwargs):
+
+        # add a task that uses the netCDF library (executed while holding vos.netcdf_lock)
+        self.enqueue(description, vos.netcdf_lock, function, args, kwargs)
+
+    def enqueue(self, description, lock, function, args, kwargs):
+
+        # add a task, executed while holding lock if lock is not None (waits if the queue is full)
+        if not self.thread.is_alive(): raise RuntimeError("The background writer has been stopped.")
+        self.tasks.put((description, lock, function, args, kwargs, number_of_bytes(list(args) + list(kwargs.values()))))
+        self.submitted += 1
+        depth = self.tasks.qsize()
+        self.max_depth = max(self.max_depth, depth)
+        logger.debug("Queued for writing: "+str(description)+" (queue depth: "+str(depth)+")")
+
+    def report(self, values, fileName, cloneMapFileName):
+
+        # PCRaster map of values (2D array with vos.MV as missing value) with the geometry of the clone map (GDAL only)
+        self.enqueue(fileName, None, writePCRasterMap, (values, fileName, vos.getMapAttributesALL(cloneMapFileName)), {})
+
+    def run(self):
+
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                self.tasks.task_done()
+                return
+            description, lock, function, args, kwargs, nbytes = task
+            if len(self.errors) > 0:
+                # the output after a failed task may be inconsistent
+                self.skipped += 1
+                logger.debug("Skipped writing: "+str(description))
+            else:
+                start = time.time()
+                try:
+                    if lock is None:
+                        function(*args, **kwargs)
+                    else:
+                        with lock:
+                            function(*args, **kwargs)
+                    self.written    += 1
+                    self.bytes      += nbytes
+                    self.write_time += time.time() - start
+                except Exception:
+                    logger.error("Writing "+str(description)+" failed.")
+                    self.errors.append((description, traceback.format_exc()))
+            # release the arrays of the task before waiting for the next one
+            task = args = kwargs = lock = None
+            self.tasks.task_done()
+
+    def statistics(self):
+
+        return {'submitted': self.submitted, 'written': self.written, 'skipped': self.skipped, \
+                'queue depth': self.tasks.qsize(), 'max. queue depth': self.max_depth, \
+                'MB': self.bytes / 1e6, 'write time (s)': self.write_time, \
+                'MB/s': self.bytes / 1e6 / self.write_time if self.write_time > 0.0 else 0.0}
+
+    def join(self):
+
+        # wait until all tasks are done and stop the writer thread; raises the error of a failed task
+        if self.thread.is_alive():
+            wait_start = time.time()
+            self.tasks.put(None)
+            self.thread.join()
+            logger.info("Waited "+str(round(time.time() - wait_start, 2))+" s for the background writer.")
+        logger.info("Background writer (total time: "+str(round(time.time() - self.start_time, 2))+" s): "+str(self.statistics()))
+        if len(self.errors) > 0:
+            description, error = self.errors[0]
+            raise RuntimeError("Writing "+str(description)+" failed ("+str(self.skipped)+" tasks skipped):\n"+error)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Benchmark of the netcdf output options of outputNetCDF.OutputNetCDF: write time, file size and the time of reading
+# windows (e.g. a regional clone from a global file), for a synthetic thickness field with missing values (oceans).
+#
+# usage: python benchmark_netcdf_output.py [output_directory] [cellsize_in_arc_minutes]
+
+import os
+import sys
+import time
+import numpy as np
+import netCDF4 as nc
+
+import outputNetCDF
+
+configurations = [
+    ("NETCDF3_CLASSIC"             , {'format': 'NETCDF3_CLASSIC'}),
+    ("NETCDF4"                     , {'format': 'NETCDF4'}),
+    ("NETCDF4 zlib"                , {'format': 'NETCDF4', 'zlib': True, 'complevel': 4, 'shuffle': True}),
+    ("NETCDF4 zlib chunks"         , {'format': 'NETCDF4', 'zlib': True, 'complevel': 4, 'shuffle': True, 'chunksizes': (256, 256)}),
+    ("NETCDF4 zlib chunks int16"   , {'format': 'NETCDF4', 'zlib': True, 'complevel': 4, 'shuffle': True, 'chunksizes': (256, 256),
+                                      'packing': {'thickness': (0.0, 10000.0)}}),
+]
+window_size          = 120       # cells
+MV                   = 1e20      # missing value (as virtualOS.MV)
+number_of_windows    = 50
+
+def finer(values, factor):
+
+    # each cell repeated factor x factor times (as virtualOS.regridData2FinerGrid)
+    return np.repeat(np.repeat(values, factor, axis = 0), factor, axis = 1)
+
+def synthetic_thickness(rows, cols):
+
+    # smooth, log-normally distributed thickness; about 70% of the cells are missing values
+    rng = np.random.RandomState(29092014)
+    coarse = rng.normal(size = (rows // 16 + 1, cols // 16 + 1))
+    field = np.exp(4.0 + 1.5 * finer(coarse, 16)[:rows, :cols] + 0.1 * rng.normal(size = (rows, cols)))
+    ocean = finer(rng.uniform(size = coarse.shape), 16)[:rows, :cols] < 0.7
+    field[ocean] = MV
+    return field.astype(np.float32)
+
+def main():
+
+    output_directory = sys.argv[1] if len(sys.argv) > 1 else "."
+    cellsize         = (float(sys.argv[2]) if len(sys.argv) > 2 else 5.0) / 60.
+    rows, cols       = int(round(180. / cellsize)), int(round(360. / cellsize))
+
+    latlon = {'lat': 90. - cellsize * (np.arange(rows) + 0.5), 'lon': -180. + cellsize * (np.arange(cols) + 0.5)}
+    field  = synthetic_thickness(rows, cols)
+
+    rng = np.random.RandomState(1)
+    windows = [(rng.randint(0, rows - window_size), rng.randint(0, cols - window_size)) for i in range(number_of_windows)]
+
+    print("grid: "+str(rows)+" x "+str(cols)+" ; "+str(number_of_windows)+" windows of "+str(window_size)+" x "+str(window_size)+" cells")
+    print("%-28s %12s %14s %18s %14s" %("configuration", "write (s)", "size (MB)", "window read (ms)", "max. error"))
+    for name, options in configurations:
+        file_name = os.path.join(output_directory, "benchmark_"+name.replace(" ", "_")+".nc")
+        output = outputNetCDF.OutputNetCDF(latlon, **options)
+
+        start = time.time()
+        with output.session(file_name):
+            output.createNetCDF(file_name, "thickness", "m")
+            output.data2NetCDF(file_name, "thickness", field)
+        write_time = time.time() - start
+
+        size = os.path.getsize(file_name) / 1e6
+
+        f = nc.Dataset(file_name)
+        start = time.time()
+        for row, col in windows: f.variables["thickness"][row:row + window_size, col:col + window_size]
+        read_time = (time.time() - start) / number_of_windows * 1000.
+        values = f.variables["thickness"][:]
+        f.close()
+
+        # maximum absolute error (of the packing, values outside the packing range are clipped)
+        defined = field != np.float32(MV)
+        expected = field[defined]
+        if 'thickness' in options.get('packing', {}): expected = np.clip(expected, *options['packing']['thickness'])
+        error = np.max(np.abs(np.ma.getdata(values)[defined] - expected))
+
+        print("%-28s %12.2f %14.1f %18.2f %14.4g" %(name, write_time, size, read_time, error))
+        os.remove(file_name)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Benchmark of the sampling schemes for z (see standard_normal.py): variance of the estimated average thickness
+# against the number of samples. For a few values of F, the thickness is D = exp(lnDavg * (1 + lnCV * F)),
+# i.e. the model without the spatial steps (extrapolation and smoothing), for which no maps are needed.
+#
+# usage: python benchmark_sampling.py [number_of_repetitions]
+
+import sys
+import time
+import numpy as np
+
+import lookup_table
+import standard_normal
+
+table_thickness = "table_from_inge/lookupDepth.txt"
+lnCV            = 0.1
+F_values        = np.array([-10.0, -5.0, 0.0, 3.75])
+sample_sizes    = [16, 64, 256, 1024]
+
+def thickness(Davg):
+
+    # thickness (sample x F value), in meter
+    return np.exp(np.log(Davg)[:,None] * (1.0 + lnCV * F_values[None,:]))
+
+def main():
+
+    number_of_repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+
+    table = lookup_table.get_table(table_thickness)
+    rows  = table.rows
+
+    # exact average (enumeration of the table values)
+    weights = np.array([standard_normal.interval_probability(*row[0:4]) for row in rows])
+    exact = np.dot(weights, thickness(np.array([row[4] for row in rows])))
+
+    print("exact average thickness for F = "+str(F_values.tolist())+": "+str(np.round(exact, 2).tolist()))
+    print("%-12s %8s %14s %14s %10s" %("sampling", "samples", "variance", "rmse", "time (s)"))
+    for sampling in standard_normal.sampling_schemes:
+        for number_of_samples in sample_sizes:
+            start = time.time()
+            estimates = []
+            for repetition in range(number_of_repetitions):
+                z = standard_normal.sample(range(1, number_of_samples + 1), number_of_samples, repetition + 1, sampling)
+                z = np.clip(z, -5.0, 5.0)
+                estimates.append(thickness(table.lookup(z.astype(np.float32))).mean(axis = 0))
+            estimates = np.array(estimates)
+            # variance of the estimated average and root mean squared error (both averaged over the F values)
+            variance = estimates.var(axis = 0, ddof = 1).mean()
+            rmse     = np.sqrt(((estimates - exact[None,:])**2).mean())
+            print("%-12s %8i %14.6g %14.6g %10.2f" %(sampling, number_of_samples, variance, rmse, (time.time() - start) / number_of_repetitions))
+
+if __name__ == '__main__':
+    sys.exit(main())
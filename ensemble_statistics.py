@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Accumulators for the statistics of a Monte Carlo ensemble, updated sample by sample (or batch by batch),
+# so that the sample maps do not have to be stored. Accumulators of different workers can be merged.
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+class RunningStatistics(object):
+
+    # per cell mean and variance, using the Welford/Chan update and merge formulas
+
+    def __init__(self, nr_cells):
+
+        object.__init__(self)
+
+        self.count = 0
+        self.mean  = np.zeros(nr_cells)
+        self.m2    = np.zeros(nr_cells)                   # sum of squared deviations from the mean
+
+    def update(self, values):
+
+        # values: one sample (cells) or a batch of samples (sample x cells)
+        values = np.atleast_2d(values)
+        batch_mean = values.mean(axis = 0)
+        batch_m2   = ((values - batch_mean)**2).sum(axis = 0)
+        self.add(values.shape[0], batch_mean, batch_m2)
+
+    def merge(self, other):
+
+        self.add(other.count, other.mean, other.m2)
+
+    def add(self, count, mean, m2):
+
+        if count == 0: return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * (float(count) / total)
+        self.m2   += m2 + delta * delta * (float(self.count) * count / total)
+        self.count = total
+
+    def variance(self, ddof = 0):
+
+        # ddof = 0: population variance (as mcaveragevariance) ; ddof = 1: sample variance
+        return self.m2 / (self.count - ddof)
+
+class LogHistogram(object):
+
+    # per cell histogram of log values with fixed bins, for percentiles without storing the samples
+    # - counts are stored for the histogram cells only (bins x histogram cells), as uint16 (or uint32 for more than
+    #   65535 samples); histogram_cells (boolean, per cell) selects e.g. the land cells (None: all cells)
+    # - values outside the bin range (including values <= 0) are counted in the first/last bin
+    # - the exact minimum and maximum are kept for all cells; the percentiles of the other cells are only known
+    #   if their value is the same in all samples (otherwise NaN)
+
+    def __init__(self, nr_cells, lower, upper, nr_bins = 128, max_samples = 65535, histogram_cells = None):
+
+        object.__init__(self)
+
+        self.lower   = float(lower)                      # in log space
+        self.upper   = float(upper)
+        self.nr_bins = int(nr_bins)
+        self.width   = (self.upper - self.lower) / self.nr_bins
+
+        self.histogram_cells = np.ones(nr_cells, dtype = bool) if histogram_cells is None else histogram_cells
+        dtype = np.uint16 if max_samples <= np.iinfo(np.uint16).max else np.uint32
+        self.counts  = np.zeros((self.nr_bins, int(self.histogram_cells.sum())), dtype = dtype)
+        self.count   = 0
+        self.minimum = np.zeros(nr_cells) + np.inf       # not in log space
+        self.maximum = np.zeros(nr_cells) - np.inf
+
+    def update(self, values):
+
+        # values (not in log space): one sample (cells) or a batch of samples (sample x cells)
+        values = np.atleast_2d(values)
+        self.count  += values.shape[0]
+        self.minimum = np.minimum(self.minimum, values.min(axis = 0))
+        self.maximum = np.maximum(self.maximum, values.max(axis = 0))
+
+        # values below the bin range (e.g. 0) are clamped to its lower bound before taking the log
+        log_values = np.log(np.maximum(values[:, self.histogram_cells], np.exp(self.lower)))
+        cells = np.arange(log_values.shape[1])
+        for sample in log_values:
+            bins = np.clip(((sample - self.lower) / self.width).astype(np.int64), 0, self.nr_bins - 1)
+            self.counts[bins, cells] += 1
+
+    def merge(self, other):
+
+        if self.count + other.count > np.iinfo(self.counts.dtype).max:
+            self.counts = self.counts.astype(np.uint32)
+        self.counts += other.counts
+        self.count  += other.count
+        self.minimum = np.minimum(self.minimum, other.minimum)
+        self.maximum = np.maximum(self.maximum, other.maximum)
+
+    def percentile(self, percentile, chunk_size = 100000):
+
+        # percentile (0.0 - 1.0) per cell, linearly interpolated (in log space) within the bin
+        target = percentile * self.count
+        nr_cells = self.counts.shape[1]
+        log_values = np.empty(nr_cells)
+        for first in range(0, nr_cells, chunk_size):
+            counts = self.counts[:, first:first + chunk_size].astype(np.int64)
+            cumulative = np.cumsum(counts, axis = 0)
+            columns = np.arange(counts.shape[1])
+            bins = np.argmax(cumulative >= max(target, 0.5), axis = 0)
+            before = cumulative[bins, columns] - counts[bins, columns]
+            fraction = (target - before) / np.maximum(1, counts[bins, columns])
+            log_values[first:first + chunk_size] = self.lower + (bins + np.clip(fraction, 0.0, 1.0)) * self.width
+
+        # the other cells: their value if it is the same in all samples
+        values = np.where(self.minimum == self.maximum, self.minimum, np.nan)
+        values[self.histogram_cells] = np.exp(log_values)
+        return np.clip(values, self.minimum, self.maximum)
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import multiprocessing.sharedctypes
+import numpy as np
+
+import pcraster as pcr
+
+import logging
+logger = logging.getLogger(__name__)
+
+import virtualOS as vos
+import lookup_table
+import standard_normal
+from ensemble_statistics import RunningStatistics, LogHistogram
+from monte_carlo_thickness import MonteCarloAquiferThickness
+
+class SampleEvaluator(object):
+
+    # Evaluation of a range of samples of the NumPy engine (see EnsembleAquiferThickness), without PCRaster,
+    # so that it can run in worker processes. The static fields (slope and intercept) can be shared arrays.
+
+    def __init__(self, slope, intercept, factor_min, factor_max, minimum_depth, \
+                       lookup_table_average_thickness, nr_samples, random_seed, sampling, batch_size, \
+                       histogram_range = None, histogram_cells = None):
+
+        object.__init__(self)
+
+        self.slope      = slope
+        self.intercept  = intercept
+        self.factor_min = factor_min
+        self.factor_max = factor_max
+        self.minimum_depth = minimum_depth
+        self.table      = lookup_table.get_table(lookup_table_average_thickness)
+        self.nr_samples  = nr_samples
+        self.random_seed = random_seed
+        self.sampling    = sampling
+        self.batch_size  = batch_size
+        self.histogram_range = histogram_range                 # (lower, upper) of log thickness, None: no histogram
+        self.histogram_cells = histogram_cells                 # cells with a histogram (None: all cells)
+
+    def average_thickness(self, sample_numbers):
+
+        # draw random values (one value for the entire map per sample)
+        z = standard_normal.sample(sample_numbers, self.nr_samples, self.random_seed, self.sampling)
+
+        # constraints, in order to make sure that random values are in the table of "lookup_table_average_thickness"
+        z = np.clip(z, -5.0, 5.0)
+
+        # assign average thickness (uniform for the entire map) based on z (single precision, as PCRaster scalar maps)
+        return self.table.lookup(z.astype(np.float32))
+
+    def is_affine(self, lnDavg):
+
+        # the minimum depth constraint is not active (for any cell)
+        lowest_lnD = np.where(lnDavg >= 0.0, lnDavg * self.factor_min, lnDavg * self.factor_max)
+        return lowest_lnD >= np.log(self.minimum_depth)
+
+    def thickness(self, lnDavg):
+
+        # sedimentary basin thickness (sample x cell), in meter (only valid if is_affine)
+        lnD = lnDavg[:,None] * self.slope[None,:] + self.intercept[None,:]
+        return np.floor(np.exp(lnD) * 100.) / 100.
+
+    def evaluate(self, first, last):
+
+        # accumulated statistics of the samples first + 1 to last, and lnDavg of the samples that are not affine
+        statistics = RunningStatistics(len(self.intercept))
+        histogram  = None
+        if self.histogram_range != None:
+            histogram = LogHistogram(len(self.intercept), self.histogram_range[0], self.histogram_range[1], \
+                                     max_samples = self.nr_samples, histogram_cells = self.histogram_cells)
+        not_affine = []
+
+        for start in range(first, last, self.batch_size):
+            end = min(start + self.batch_size, last)
+            lnDavg = np.log(self.average_thickness(range(start + 1, end + 1)))
+            affine = self.is_affine(lnDavg)
+            not_affine += list(lnDavg[~ affine])
+            if affine.any():
+                D = self.thickness(lnDavg[affine])
+                statistics.update(D)
+                if histogram != None: histogram.update(D)
+
+        return statistics, histogram, not_affine
+
+# sample evaluator of a worker process
+worker_evaluator = None
+
+def initialize_worker(shared_slope, shared_intercept, settings):
+
+    global worker_evaluator
+    worker_evaluator = SampleEvaluator(np.frombuffer(shared_slope), np.frombuffer(shared_intercept), **settings)
+
+def evaluate_in_worker(sample_range):
+
+    return worker_evaluator.evaluate(sample_range[0], sample_range[1])
+
+class EnsembleAquiferThickness(MonteCarloAquiferThickness):
+
+    # NumPy engine for the Monte Carlo simulation of MonteCarloAquiferThickness.
+    #
+    # Within the sample loop, only the (uniform) value lnDavg changes. As long as
+    # the minimum depth constraint is not active, lnD = lnDavg * (1 + lnCV * F) and
+    # all following cover/windowaverage steps are affine in lnDavg. Hence, the
+    # smoothed log thickness of every sample is lnDavg * slope + intercept, with
+    # both maps calculated once with the PCRaster steps of the original model.
+    # The samples are then evaluated in batches as (sample x cell) arrays.
+    #
+    # The sampling option is one of standard_normal.sampling_schemes or "exact".
+    # With sampling = "exact", the random sampling of z is replaced by the enumeration
+    # of the (few) distinct values of Davg in the table "lookup_table_average_thickness",
+    # each weighted by its probability, giving the exact statistics of the ensemble.
+    #
+    # With a tolerance, the (random) samples are drawn in batches until the relative change
+    # of the running mean and the relative standard error of the mean (maximum over the
+    # land cells with a positive mean) are both below the tolerance, or until number_of_samples is reached.
+    #
+    # With number_of_cores > 1, the samples are evaluated by a pool of worker processes,
+    # with slope and intercept in shared memory. The workers only return their accumulated
+    # statistics, which are merged.
+
+    def __init__(self, clone_map_file, \
+                       dem_average_netcdf, dem_floodplain_netcdf, ldd_netcdf, \
+                       lookup_table_average_thickness, lookup_table_zscore, \
+                       number_of_samples, include_percentile = True,\
+                       threshold_sedimentary_basin = 50.0, elevation_F_min = 0.0, elevation_F_max = 50.0,\
+                       batch_size = 100, random_seed = None, sampling = "plain", tolerance = None, \
+                       number_of_cores = 1):
+
+        MonteCarloAquiferThickness.__init__(self, clone_map_file, \
+                                            dem_average_netcdf, dem_floodplain_netcdf, ldd_netcdf, \
+                                            lookup_table_average_thickness, lookup_table_zscore, \
+                                            number_of_samples, include_percentile, \
+                                            threshold_sedimentary_basin, elevation_F_min, elevation_F_max, \
+                                            report_sample_maps = False, random_seed = random_seed, \
+                                            sampling = "plain" if sampling == "exact" else sampling)
+
+        self.batch_size  = int(batch_size)
+        self.sampling    = sampling
+        self.tolerance   = tolerance
+        self.number_of_cores = int(number_of_cores)
+        if self.tolerance != None and self.sampling in ["stratified", "lhs", "exact"]:
+            raise ValueError("A tolerance cannot be used with the sampling option: "+str(self.sampling))
+
+        logger.info("Step 3b: Calculate the response of log thickness to lnDavg (shared by all samples).")
+        intercept = self.ln_thickness(pcr.scalar(0.0))
+        slope     = self.ln_thickness(pcr.scalar(1.0)) - intercept
+
+        # cells that get a thickness value
+        self.cells = pcr.pcr2numpy(pcr.defined(intercept), 0) == 1
+        self.intercept = pcr.pcr2numpy(intercept, vos.MV)[self.cells].astype(np.float64)
+        self.slope     = pcr.pcr2numpy(slope    , vos.MV)[self.cells].astype(np.float64)
+        self.land_cells = pcr.pcr2numpy(self.landmask, 0)[self.cells] == 1
+
+        # range of the factor (1 + lnCV * F), used to check the minimum depth constraint
+        factor = 1.0 + self.lnCV * self.F
+        factor_min = pcr.cellvalue(pcr.mapminimum(factor), 1)[0]
+        factor_max = pcr.cellvalue(pcr.mapmaximum(factor), 1)[0]
+
+        # settings of the sample evaluator (also used for worker processes)
+        self.evaluator_settings = {'factor_min': factor_min, 'factor_max': factor_max, \
+                                   'minimum_depth': self.minimum_depth, \
+                                   'lookup_table_average_thickness': self.lookup_table_average_thickness, \
+                                   'nr_samples': self.nr_samples, 'random_seed': self.random_seed, \
+                                   'sampling': self.sampling, 'batch_size': self.batch_size, \
+                                   'histogram_range': None, 'histogram_cells': None}
+        if self.include_percentile and not self.percentile_by_quantile:
+            self.evaluator_settings['histogram_range'] = (np.log(self.minimum_depth), np.log(self.maximum_depth))
+            # histograms for the land cells that vary over the samples only; the thickness of the cells with slope = 0
+            # is the same in all (affine) samples
+            histogram_cells = self.land_cells & (self.slope != 0.0)
+            self.evaluator_settings['histogram_cells'] = histogram_cells
+            logger.info("Histograms (for percentiles) for "+str(int(histogram_cells.sum()))+" of "+str(len(self.slope))+" cells.")
+        self.evaluator = SampleEvaluator(self.slope, self.intercept, **self.evaluator_settings)
+
+    def thickness_batch(self, lnDavg):
+
+        # sedimentary basin thickness (sample x cell), in meter
+        D = self.evaluator.thickness(lnDavg)
+
+        # samples for which the minimum depth constraint is active are evaluated with PCRaster
+        for i in np.where(~ self.evaluator.is_affine(lnDavg))[0]:
+            D[i,:] = self.thickness_with_pcraster(lnDavg[i])
+
+        return D
+
+    def thickness_with_pcraster(self, lnDavg):
+
+        logger.info("The minimum depth constraint is active for lnDavg = "+str(lnDavg)+". This sample is evaluated with PCRaster.")
+        return pcr.pcr2numpy(self.thickness(pcr.scalar(float(lnDavg))), vos.MV)[self.cells]
+
+    def run(self):
+
+        if self.sampling == "exact":
+            self.run_exact()
+        else:
+            self.run_samples()
+
+    def run_samples(self):
+
+        logger.info("Step 4: Monte Carlo simulation (NumPy engine, "+str(self.nr_samples)+" samples in batches of "+str(self.batch_size)+", sampling: "+str(self.sampling)+")")
+
+        self.statistics = RunningStatistics(len(self.intercept))
+        self.histogram  = None
+        self.previous_mean = None
+
+        pool = None
+        if self.number_of_cores > 1:
+            logger.info("Starting a pool of "+str(self.number_of_cores)+" worker processes.")
+            shared_slope     = multiprocessing.sharedctypes.RawArray('d', len(self.slope))
+            shared_intercept = multiprocessing.sharedctypes.RawArray('d', len(self.intercept))
+            np.frombuffer(shared_slope)[:]     = self.slope
+            np.frombuffer(shared_intercept)[:] = self.intercept
+            pool = multiprocessing.Pool(self.number_of_cores, initialize_worker, \
+                                        (shared_slope, shared_intercept, self.evaluator_settings))
+
+        # samples per round: all samples at once, or (with a tolerance) one batch per core, followed by a convergence check
+        round_size = self.nr_samples
+        if self.tolerance != None: round_size = self.batch_size * self.number_of_cores
+
+        for first in range(0, self.nr_samples, round_size):
+
+            last = min(first + round_size, self.nr_samples)
+
+            # sample ranges, one per core
+            bounds = np.linspace(first, last, min(self.number_of_cores, last - first) + 1).astype(int)
+            sample_ranges = [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+            if pool == None:
+                results = [self.evaluator.evaluate(start, end) for start, end in sample_ranges]
+            else:
+                results = pool.map(evaluate_in_worker, sample_ranges)
+
+            for statistics, histogram, not_affine in results:
+                self.statistics.merge(statistics)
+                if histogram != None:
+                    if self.histogram == None:
+                        self.histogram = histogram
+                    else:
+                        self.histogram.merge(histogram)
+                for lnDavg in not_affine:
+                    D = self.thickness_with_pcraster(lnDavg)
+                    self.statistics.update(D)
+                    if self.histogram != None: self.histogram.update(D)
+
+            logger.info("Samples "+str(first + 1)+" to "+str(last)+" are done.")
+
+            if self.tolerance != None and self.is_converged(): break
+
+        if pool != None:
+            pool.close()
+            pool.join()
+
+        if self.statistics.count < self.nr_samples:
+            self.nr_samples = self.statistics.count
+            self.number_of_samples = pcr.scalar(self.nr_samples)
+
+        logger.info("Step 5: Reporting the results.")
+
+        self.average            = self.to_map(self.statistics.mean)
+        self.average_variance   = self.to_map(self.statistics.variance(ddof = 0))
+        self.standard_deviation = self.to_map(np.sqrt(self.statistics.variance(ddof = 1)))
+
+        self.percentileList = [0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+        if self.percentile_by_quantile:
+            self.percentiles = self.percentiles_from_quantiles(self.percentileList)
+        elif self.include_percentile:
+            self.percentiles = self.percentiles_from_histogram(self.percentileList)
+
+    def is_converged(self):
+
+        # relative change of the running mean (since the previous batch) and relative standard error of the mean
+        mean = self.statistics.mean
+        previous_mean = self.previous_mean
+        self.previous_mean = mean.copy()
+        if previous_mean is None or self.statistics.count < 2: return False
+
+        # over the land cells with a positive mean (e.g. cells with the minimum depth only have D = 0 in all samples)
+        cells = self.land_cells & (mean > 0.0)
+        if not cells.any(): return False
+        relative_change = np.max(np.abs(mean[cells] - previous_mean[cells]) / mean[cells])
+        relative_error  = np.max(np.sqrt(self.statistics.variance(ddof = 1)[cells] / self.statistics.count) / mean[cells])
+
+        msg = "Samples used: "+str(self.statistics.count)+" ; relative change of the mean: "+str(relative_change)+" ; relative standard error: "+str(relative_error)+\
+              " ; cells left out (not land, or a mean of 0): "+str(int(len(mean) - cells.sum()))
+        logger.info(msg)
+
+        converged = relative_change <= self.tolerance and relative_error <= self.tolerance
+        if converged: logger.info("The statistics converged (tolerance: "+str(self.tolerance)+") after "+str(self.statistics.count)+" samples.")
+        return converged
+
+    def distinct_average_thickness(self):
+
+        # distinct values of Davg and their probabilities (z is clamped to [-5, 5])
+        probability = {}
+        for lower, lower_closed, upper, upper_closed, value in lookup_table.get_table(self.lookup_table_average_thickness).rows:
+            p = standard_normal.interval_probability(lower, lower_closed, upper, upper_closed)
+            if p > 0.0: probability[value] = probability.get(value, 0.0) + p
+        Davg   = np.array(sorted(probability.keys()))
+        weight = np.array([probability[value] for value in Davg])
+        return Davg, weight / weight.sum()
+
+    def run_exact(self):
+
+        Davg, weight = self.distinct_average_thickness()
+
+        logger.info("Step 4: Enumeration of the "+str(len(Davg))+" distinct values of Davg (NumPy engine)")
+
+        sum_D         = np.zeros(self.intercept.shape)
+        sum_D_squared = np.zeros(self.intercept.shape)
+        store_ensemble = self.include_percentile and not self.percentile_by_quantile
+        if store_ensemble: ensemble = []
+
+        for first in range(0, len(Davg), self.batch_size):
+
+            last = min(first + self.batch_size, len(Davg))
+            D = self.thickness_batch(np.log(Davg[first:last]))
+
+            sum_D         += np.dot(weight[first:last], D)
+            sum_D_squared += np.dot(weight[first:last], D * D)
+
+            if store_ensemble: ensemble.append(D.astype(np.float32))
+
+        logger.info("Step 5: Reporting the results.")
+
+        average  = sum_D
+        variance = np.maximum(0.0, sum_D_squared - average * average)
+
+        self.average            = self.to_map(average)
+        self.average_variance   = self.to_map(variance)
+        self.standard_deviation = self.to_map(np.sqrt(variance))
+
+        self.percentileList = [0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+        if self.percentile_by_quantile:
+            self.percentiles = self.percentiles_from_quantiles(self.percentileList)
+        elif self.include_percentile:
+            # weighted percentiles: the lowest value for which the cumulative probability reaches the percentile
+            ensemble = np.concatenate(ensemble, axis = 0)
+            order = np.argsort(ensemble, axis = 0)
+            cumulative = np.cumsum(weight[order], axis = 0)
+            self.percentiles = {}
+            for percentile in self.percentileList:
+                index = np.minimum(np.argmax(cumulative >= percentile * (1.0 - 1e-12), axis = 0), len(Davg) - 1)
+                rank  = order[index, np.arange(ensemble.shape[1])]
+                self.percentiles[percentile] = self.to_map(ensemble[rank, np.arange(ensemble.shape[1])])
+            ensemble = None ; order = None ; cumulative = None
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Reading and evaluating PCRaster lookup tables (e.g. the tables in table_from_inge) with a single key column.
+# A key is either a single value or an interval, e.g. "<-5,-3.95]", "[0,3.16E-05]" or "<4,>".
+# An empty bound means that the interval is unbounded at that side.
+
+import os
+import re
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+interval_pattern = re.compile(r"^([\[<])\s*([^,]*)\s*,\s*([^\]>]*)\s*([\]>])$")
+
+def parse_key(key):
+
+    # returns (lower, lower_closed, upper, upper_closed)
+    match = interval_pattern.match(key)
+    if match == None:
+        value = float(key)
+        return (value, True, value, True)
+    lower_bracket, lower, upper, upper_bracket = match.groups()
+    lower = float(lower) if lower.strip() != "" else float("-inf")
+    upper = float(upper) if upper.strip() != "" else float("inf")
+    return (lower, lower_bracket == "[", upper, upper_bracket == "]")
+
+def read_table(table_file):
+
+    # returns a list of rows: (lower, lower_closed, upper, upper_closed, value)
+    rows = []
+    for line in open(table_file):
+        line = line.strip()
+        if line == "" or line.startswith("#"): continue
+        key, value = line.split()[0:2]
+        rows.append(parse_key(key) + (float(value),))
+    return rows
+
+class LookupTable(object):
+
+    # A lookup table, parsed once, that is evaluated for NumPy arrays with the same results as pcr.lookupscalar:
+    # the value of the first matching row, or missing_value if there is no matching row.
+    # If the keys do not overlap (as in the tables of table_from_inge), the matching row is found
+    # with a binary search over the sorted lower bounds; otherwise, all rows are evaluated.
+
+    def __init__(self, table_file):
+
+        object.__init__(self)
+
+        self.table_file = table_file
+        self.rows = read_table(table_file)
+
+        rows = sorted(self.rows, key = lambda row: (row[0], not row[1]))
+        self.lower        = np.array([row[0] for row in rows])
+        self.lower_closed = np.array([row[1] for row in rows])
+        self.upper        = np.array([row[2] for row in rows])
+        self.upper_closed = np.array([row[3] for row in rows])
+        self.values       = np.array([row[4] for row in rows])
+
+        # whether the keys overlap
+        self.overlapping = False
+        for i in range(len(rows) - 1):
+            if self.upper[i] > self.lower[i + 1] or \
+              (self.upper[i] == self.lower[i + 1] and self.upper_closed[i] and self.lower_closed[i + 1]):
+                self.overlapping = True
+        if self.overlapping: logger.info("The keys in the table "+str(table_file)+" overlap.")
+
+    def lookup(self, values, missing_value = np.nan):
+
+        values = np.asarray(values, dtype = np.float64)
+        result = np.zeros(values.shape) + missing_value
+
+        if self.overlapping:
+            # the first matching row has the priority
+            for lower, lower_closed, upper, upper_closed, value in reversed(self.rows):
+                result[contains(values, lower, lower_closed, upper, upper_closed)] = value
+            return result
+
+        # the last row with a lower bound <= value, or the row before it (if the value is at its closed upper bound)
+        index = np.searchsorted(self.lower, values, side = 'right') - 1
+        found = np.zeros(values.shape, dtype = bool)
+        for candidate in [index, index - 1]:
+            valid = (candidate >= 0) & ~ found
+            candidate = np.maximum(0, candidate)
+            inside = valid & contains(values, self.lower[candidate], self.lower_closed[candidate], \
+                                              self.upper[candidate], self.upper_closed[candidate])
+            result[inside] = self.values[candidate[inside]]
+            found |= inside
+        return result
+
+def contains(values, lower, lower_closed, upper, upper_closed):
+
+    above_lower = (values > lower) | ((values == lower) & lower_closed)
+    below_upper = (values < upper) | ((values == upper) & upper_closed)
+    return above_lower & below_upper
+
+# parsed tables (key: file name, value: (modification time, table))
+tablecache = dict()
+
+def get_table(table_file):
+
+    modification_time = os.path.getmtime(table_file)
+    if table_file not in tablecache or tablecache[table_file][0] != modification_time:
+        tablecache[table_file] = (modification_time, LookupTable(table_file))
+    return tablecache[table_file][1]
+
+def lookupscalar(table_file, pcr_map):
+
+    # replacement of pcr.lookupscalar(table_file, pcr_map) for a spatial map 
+    # (PCRaster is imported here only, so that the tables can be used without PCRaster, e.g. in benchmark_sampling.py)
+    import pcraster as pcr
+    import virtualOS as vos
+    values = pcr.pcr2numpy(pcr.scalar(pcr_map), np.nan)
+    return pcr.numpy2pcr(pcr.Scalar, get_table(table_file).lookup(values, vos.MV), vos.MV)
@@ -11,6 +11,9 @@ import logging
 logger = logging.getLogger(__name__)
 
 import virtualOS as vos
+import lookup_table
+import window_average
+import rasterize
 
 class MargatCorrection(object):
 
@@ -20,7 +23,8 @@ class MargatCorrection(object):
                        margat_aquifers,\
                        tmp_directory,
                        landmask = None,
-                       arcdegree = True):
+                       arcdegree = True,
+                       input_thickness_map = None):
 
         object.__init__(self)
 
@@ -32,56 +36,33 @@ class MargatCorrection(object):
         self.clone_map_attr = vos.getMapAttributesALL(self.clone_map_file)
         if arcdegree == True:
             self.clone_map_attr['cellsize'] = round(self.clone_map_attr['cellsize'] * 360000.)/360000.
-        xmin = self.clone_map_attr['xUL']
-        xmax = xmin + self.clone_map_attr['cols'] * self.clone_map_attr['cellsize']
-        ymax = self.clone_map_attr['yUL']
-        ymin = ymax - self.clone_map_attr['rows'] * self.clone_map_attr['cellsize']
         pcr.setclone(self.clone_map_file)
 
         # temporary directory 
         self.tmp_directory = tmp_directory
 
         # thickness approximation (unit: m, file in netcdf with variable name = average 
-        self.approx_thick = vos.netcdf2PCRobjCloneWithoutTime(input_thickness_netcdf_file,\
-                                                              input_thickness_var_name,\
-                                                              self.clone_map_file)
+        # or, if given, the map input_thickness_map, e.g. while the netcdf file is still being written)
+        if input_thickness_map is not None:
+            self.approx_thick = pcr.scalar(input_thickness_map)
+        else:
+            self.approx_thick = vos.netcdf2PCRobjCloneWithoutTime(input_thickness_netcdf_file,\
+                                                                  input_thickness_var_name,\
+                                                                  self.clone_map_file)
         # set minimum value to 0.1 mm
         self.approx_thick = pcr.max(0.0001, self.approx_thick)
 
-        # rasterize the shape file 
-        #               -        
-        # save current directory and move to temporary directory
-        current_dir = str(os.getcwd()+"/")
-        os.chdir(str(self.tmp_directory))
-        #
-        cmd_line  = 'gdal_rasterize -a MARGAT '                                     # layer name = MARGAT
-        cmd_line += '-te '+str(xmin)+' '+str(ymin)+' '+str(xmax)+' '+str(ymax)+ ' '       
-        cmd_line += '-tr '+str(self.clone_map_attr['cellsize'])+' '+str(self.clone_map_attr['cellsize'])+' '
-        cmd_line += str(margat_aquifers['shapefile'])+' '
-        cmd_line += 'tmp.tif'
-        print(cmd_line); os.system(cmd_line)
-        #
-        # make it nomial
-        cmd_line = 'pcrcalc tmp.map = "nominal(tmp.tif)"' 
-        print(cmd_line); os.system(cmd_line)
-        #
-        # make sure that the clone map is correct
-        cmd_line = 'mapattr -c '+str(self.clone_map_file)+' tmp.map'
-        print(cmd_line); os.system(cmd_line)
-        #
-        # read the map
-        self.margat_aquifer_map = pcr.nominal(pcr.readmap("tmp.map"))
-        #
-        # clean temporary directory and return to the original directory
-        vos.clean_tmp_dir(self.tmp_directory)
-        os.chdir(current_dir)
+        # rasterize the shape file (in process, cached if margat_aquifers['rasterized_cache'] is given)
+        aquifer_ids = rasterize.rasterize(margat_aquifers['shapefile'], 'MARGAT', self.clone_map_attr, \
+                                          margat_aquifers.get('rasterized_cache', None))
+        self.margat_aquifer_map = pcr.numpy2pcr(pcr.Nominal, aquifer_ids, -1)
         
         # extend the extent of each aquifer
         self.margat_aquifer_map = pcr.cover(self.margat_aquifer_map, 
                                   pcr.windowmajority(self.margat_aquifer_map, 1.25))
 
         # assign aquifer thickness, unit: m (lookuptable operation) 
-        self.margat_aquifer_thickness = pcr.lookupscalar(margat_aquifers['txt_table'], self.margat_aquifer_map)
+        self.margat_aquifer_thickness = lookup_table.lookupscalar(margat_aquifers['txt_table'], self.margat_aquifer_map)
         self.margat_aquifer_thickness = pcr.ifthen(self.margat_aquifer_thickness > 0., \
                                                    self.margat_aquifer_thickness)
         #~ pcr.report(self.margat_aquifer_thickness,"thick.map"); os.system("aguila thick.map")
@@ -89,17 +70,8 @@ class MargatCorrection(object):
         # aquifer map
         self.margat_aquifer_map       = pcr.ifthen(self.margat_aquifer_thickness > 0., self.margat_aquifer_map)        
         
-        # looping per aquifer: cirrecting or rescaling 
-        aquifer_ids = np.unique(pcr.pcr2numpy(pcr.scalar(self.margat_aquifer_map), vos.MV))
-        aquifer_ids = aquifer_ids[aquifer_ids > 0]
-        aquifer_ids = aquifer_ids[aquifer_ids < 10000]
-        self.rescaled_thickness = None
-        for id in aquifer_ids:
-            rescaled_thickness = self.correction_per_aquifer(id)
-            try:
-                self.rescaled_thickness = pcr.cover(self.rescaled_thickness, rescaled_thickness)
-            except:
-                self.rescaled_thickness = rescaled_thickness
+        # correcting or rescaling, for all aquifers at once
+        self.rescaled_thickness = self.correction_all_aquifers()
         
         # integrating
         ln_aquifer_thickness  = self.mapFilling( pcr.ln(self.rescaled_thickness), pcr.ln(self.approx_thick) )
@@ -114,44 +86,67 @@ class MargatCorrection(object):
         self.aquifer_thickness = pcr.ifthen(self.landmask, self.aquifer_thickness)
         #~ pcr.report(self.aquifer_thickness,"thick.map"); os.system("aguila thick.map")
 
-    def correction_per_aquifer(self, id):
+    def correction_all_aquifers(self):
         
-        id = float(id); print id
+        # aquifer ids, logarithmic values of Margat values and logarithmic values of 'estimated thickness' 
+        aquifer_ids      = pcr.pcr2numpy(pcr.scalar(self.margat_aquifer_map), np.nan)
+        exp_margat_thick = pcr.pcr2numpy(pcr.ln(self.margat_aquifer_thickness), np.nan)
+        exp_approx_thick = pcr.pcr2numpy(pcr.ln(self.approx_thick), np.nan)
+        correct_thickness = np.zeros(aquifer_ids.shape) + np.nan
         
-        # identify aquifer mask  
-        aquifer_landmask = pcr.ifthen(self.margat_aquifer_map == pcr.nominal(id), pcr.boolean(1))
+        # cells of all aquifers, sorted by aquifer id
+        with np.errstate(invalid = 'ignore'):
+            cells = np.flatnonzero((aquifer_ids > 0) & (aquifer_ids < 10000))
+        cells = cells[np.argsort(aquifer_ids.flat[cells], kind = 'mergesort')]
+        ids, first = np.unique(aquifer_ids.flat[cells], return_index = True)
+        logger.info("Correcting the thickness of "+str(len(ids))+" aquifers.")
         
-        # obtain the logarithmic value of Margat value
-        exp_margat_thick = pcr.cellvalue(\
-                           pcr.mapmaximum(\
-                           pcr.ifthen(aquifer_landmask, pcr.ln(self.margat_aquifer_thickness))), 1)[0]
-
-        # obtain the logarithmic values of 'estimated thickness'
-        exp_approx_thick = pcr.ifthen(aquifer_landmask, pcr.ln(self.approx_thick)) 
-                       
-        exp_approx_thick_array = pcr.pcr2numpy(exp_approx_thick, vos.MV)
-        exp_approx_thick_array = exp_approx_thick_array[exp_approx_thick_array <> vos.MV]
-        exp_approx_thick_array = exp_approx_thick_array[exp_approx_thick_array < 1000000.]
+        # Margat value (maximum) per aquifer
+        margat = np.fmax.reduceat(exp_margat_thick.flat[cells], first) if len(ids) > 0 else np.zeros(0)
+        
+        # percentiles (linear interpolation, as np.percentile) of the 'estimated thickness' values per aquifer
+        with np.errstate(invalid = 'ignore'):
+            samples = cells[exp_approx_thick.flat[cells] < 1000000.]
+        samples = samples[np.lexsort((exp_approx_thick.flat[samples], aquifer_ids.flat[samples]))]
+        values  = exp_approx_thick.flat[samples]
+        sample_ids, sample_first, sample_count = np.unique(aquifer_ids.flat[samples], return_index = True, return_counts = True)
+        
+        def percentile(p):
+            position = p / 100. * (sample_count - 1)
+            lower    = np.floor(position).astype(np.int64)
+            upper    = np.minimum(lower + 1, sample_count - 1)
+            return values[sample_first + lower] + (position - lower) * (values[sample_first + upper] - values[sample_first + lower])
+        
+        exp_approx_minim = percentile( 2.5)
+        exp_approx_maxim = percentile(97.5)
+        
+        # aquifers without any 'estimated thickness' values are not corrected
+        if len(sample_ids) < len(ids): logger.info("No thickness estimates for the aquifers: "+str(np.setdiff1d(ids, sample_ids).tolist()))
+        cells = cells[np.isin(aquifer_ids.flat[cells], sample_ids)]
+        index = np.searchsorted(sample_ids, aquifer_ids.flat[cells])
+        exp_approx_thick = exp_approx_thick.flat[cells]
+        exp_margat_thick = margat[np.searchsorted(ids, sample_ids)][index]
+        exp_approx_minim = exp_approx_minim[index]
+        exp_approx_maxim = exp_approx_maxim[index]
+        
+        # correcting (a zero range gives missing values, as a division by zero in PCRaster)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            exp_approx_thick_correct  = ( exp_approx_thick - exp_approx_minim ) / \
+                                        ( exp_approx_maxim - exp_approx_minim )   
+            exp_approx_thick_correct[exp_approx_maxim == exp_approx_minim] = np.nan
+            exp_approx_thick_correct  = np.maximum(0.0, exp_approx_thick_correct)
+            exp_approx_thick_correct *= np.maximum(0.0,\
+                                        ( exp_margat_thick - exp_approx_minim ) )
+            exp_approx_thick_correct += np.minimum(exp_approx_minim, exp_approx_thick)
+        
+            # maximum thickness
+            exp_approx_thick_correct  = np.minimum(exp_margat_thick, exp_approx_thick_correct)
         
-        # identify percentile
-        exp_approx_minim = np.percentile(exp_approx_thick_array,  2.5);
-        exp_approx_maxim = np.percentile(exp_approx_thick_array, 97.5); 
-
-        # correcting
-        exp_approx_thick_correct  = ( exp_approx_thick - exp_approx_minim ) / \
-                                    ( exp_approx_maxim - exp_approx_minim )   
-        exp_approx_thick_correct  = pcr.max(0.0, exp_approx_thick_correct )
-        exp_approx_thick_correct *= pcr.max(0.0,\
-                                    ( exp_margat_thick - exp_approx_minim ) )
-        exp_approx_thick_correct += pcr.min(exp_approx_minim, exp_approx_thick)
-
-        # maximum thickness
-        exp_approx_thick_correct  = pcr.min(exp_margat_thick, exp_approx_thick_correct)
-
         # corrected thickness
-        correct_thickness = pcr.exp(exp_approx_thick_correct)
+        correct_thickness.flat[cells] = np.exp(exp_approx_thick_correct)
+        correct_thickness[np.isnan(correct_thickness)] = vos.MV
         
-        return correct_thickness
+        return pcr.numpy2pcr(pcr.Scalar, correct_thickness, vos.MV)
       
     def mapFilling(self, map_with_MV, map_without_MV, method = "window_average"):
     
@@ -166,35 +161,34 @@ class MargatCorrection(object):
                                pcr.boolean(1),)
             map_with_MV_intrpl = pcr.inversedistance(interpolatedMask, \
                                                    map_with_MV, 2, 1.50, 25)
+            #
+            # - interpolated values are only introduced in cells with MV 
+            map_with_MV_intrpl = pcr.cover(map_with_MV, map_with_MV_intrpl)
+            #
+            # - calculating weight factor:
+            weight_factor = pcr.scalar(pcr.defined(map_with_MV))
+            weight_factor = window_average.windowaverage(0.70*weight_factor, 1.50) +\
+                            window_average.windowaverage(0.25*weight_factor, 2.00) +\
+                            window_average.windowaverage(0.05*weight_factor, 2.50)
+            weight_factor = pcr.min(1.0, weight_factor)
+            weight_factor = pcr.max(0.0, weight_factor)
+            weight_factor = pcr.cover(weight_factor, 0.0)
+            #
+            # merge with weight factor
+            merged_map = weight_factor  * map_with_MV_intrpl + \
+                  (1.0 - weight_factor) * map_without_MV
+            #
+            # retain the original values and make sure that all values are covered
+            filled_map = pcr.cover(map_with_MV, merged_map)
+            filled_map = pcr.cover(filled_map, map_without_MV)
         #
         else: # method 2: using window average
             logger.info('Extrapolation using "modified window average" in progress!')
             #
-            map_with_MV_intrpl = 0.70 * pcr.windowaverage(map_with_MV, 1.50) + \
-                                 0.25 * pcr.windowaverage(map_with_MV, 2.00) + \
-                                 0.05 * pcr.windowaverage(map_with_MV, 2.50) + \
-                                 pcr.scalar(0.0)
-        #
-        # - interpolated values are only introduced in cells with MV 
-        map_with_MV_intrpl = pcr.cover(map_with_MV, map_with_MV_intrpl)
-        #
-        # - calculating weight factor:
-        weight_factor = pcr.scalar(pcr.defined(map_with_MV))
-        weight_factor = pcr.windowaverage(0.70*weight_factor, 1.50) +\
-                        pcr.windowaverage(0.25*weight_factor, 2.00) +\
-                        pcr.windowaverage(0.05*weight_factor, 2.50)
-        weight_factor = pcr.min(1.0, weight_factor)
-        weight_factor = pcr.max(0.0, weight_factor)
-        weight_factor = pcr.cover(weight_factor, 0.0)
-        #
-        # merge with weight factor
-        merged_map = weight_factor  * map_with_MV_intrpl + \
-              (1.0 - weight_factor) * map_without_MV
-        #
-        # retain the original values and make sure that all values are covered
-        filled_map = pcr.cover(map_with_MV, merged_map)
-        filled_map = pcr.cover(filled_map, map_without_MV)
+            # - interpolation, weight factor and merging (as for method 1, with window averages as interpolated values) 
+            #   for all windows (length, weight) at once
+            filled_map = window_average.windowfilling(map_with_MV, map_without_MV, \
+                                                      [(1.50, 0.70), (2.00, 0.25), (2.50, 0.05)])
     
         logger.info('Extrapolation is done!')
         return filled_map
-
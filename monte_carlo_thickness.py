@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import math
+import numpy as np
+
 from pcraster.framework import *
 import pcraster as pcr
 
@@ -8,6 +11,10 @@ import logging
 logger = logging.getLogger(__name__)
 
 import virtualOS as vos
+import lookup_table
+import window_average
+import standard_normal
+from ensemble_statistics import RunningStatistics, LogHistogram
 
 class MonteCarloAquiferThickness(DynamicModel, MonteCarloModel):
 
@@ -15,7 +22,8 @@ class MonteCarloAquiferThickness(DynamicModel, MonteCarloModel):
                        dem_average_netcdf, dem_floodplain_netcdf, ldd_netcdf, \
                        lookup_table_average_thickness, lookup_table_zscore, \
                        number_of_samples, include_percentile = True,\
-                       threshold_sedimentary_basin = 50.0, elevation_F_min = 0.0, elevation_F_max = 50.0):  # values defined in de Graaf et al. (2014)
+                       threshold_sedimentary_basin = 50.0, elevation_F_min = 0.0, elevation_F_max = 50.0,\
+                       report_sample_maps = True, random_seed = None, sampling = "plain"):  # values defined in de Graaf et al. (2014)
 
         DynamicModel.__init__(self)
         MonteCarloModel.__init__(self)
@@ -35,6 +43,23 @@ class MonteCarloAquiferThickness(DynamicModel, MonteCarloModel):
         
         # number of samples
         self.number_of_samples = pcr.scalar(number_of_samples)
+        self.nr_samples        = int(number_of_samples)
+        
+        # an option to report the maps of every sample (davg and damc); 
+        # if False, the statistics are accumulated in memory (this requires samples that are not forked) 
+        self.report_sample_maps = report_sample_maps
+        self.cells      = None                                              # cells with thickness values
+        self.statistics = None                                              # accumulated mean and variance
+        self.histogram  = None                                              # accumulated histogram (for percentiles)
+        
+        # seed of the run: the random value of every sample is drawn from a stream keyed by this seed and the sample number
+        self.random_seed = random_seed if random_seed != None else standard_normal.new_seed()
+        logger.info("Random seed: "+str(self.random_seed))
+        
+        # sampling scheme for z (see standard_normal.sampling_schemes)
+        self.sampling = sampling
+        if self.sampling not in standard_normal.sampling_schemes:
+            raise ValueError("Unknown sampling option: "+str(self.sampling))
         
         logger.info("Step 1: Identify the cells belonging to the sedimentary basin region.")
         dem_average    = vos.netcdf2PCRobjCloneWithoutTime(dem_average_netcdf['file_name'],\
@@ -72,7 +97,7 @@ class MonteCarloAquiferThickness(DynamicModel, MonteCarloModel):
         logger.info("Step 2: Calculate relative difference and associate z_score.")
         relative_elevation_F = pcr.scalar(1.0) - (elevation_F - elevation_F_min)/(elevation_F_max - elevation_F_min)
         
-        z_score_relat_elev_F = pcr.lookupscalar(lookup_table_zscore, relative_elevation_F)  
+        z_score_relat_elev_F = lookup_table.lookupscalar(lookup_table_zscore, relative_elevation_F)  
         self.F = z_score_relat_elev_F   # zscore (varying over the map)
         
         # maximum and minimum z_score
@@ -82,6 +107,11 @@ class MonteCarloAquiferThickness(DynamicModel, MonteCarloModel):
         logger.info("Step 3: Assign average and variation of aquifer thickness.")
         self.lookup_table_average_thickness = lookup_table_average_thickness
         self.lnCV = pcr.scalar(0.1)                                          # According to Inge, this lnCV value corresponds to the table "lookup_table_average_thickness".
+        self.minimum_depth = 0.005                                           # the minimum depth (must be bigger than zero)
+        self.maximum_depth = 10000.                                          # upper limit of the histogram used for percentiles (see update_statistics)
+
+        # percentiles from the quantiles of z (if possible) or from all samples
+        self.percentile_by_quantile = self.include_percentile and self.is_monotonic_in_z()
 
     def premcloop(self):
         pass 
@@ -94,73 +124,167 @@ class MonteCarloAquiferThickness(DynamicModel, MonteCarloModel):
         logger.info("Step 4: Monte Carlo simulation")
 
         # draw a random value (uniform for the entire map)
-        z = pcr.mapnormal() ; #~ self.report(z,"z")
+        z = standard_normal.sample([self.currentSampleNumber()], self.nr_samples, self.random_seed, self.sampling)[0]
         
         # constraints, in order to make sure that random values are in the table of "lookup_table_average_thickness" 
-        z = pcr.max(-5.0, z)
-        z = pcr.min( 5.0, z)
+        z = min(5.0, max(-5.0, z))
         
-        # assign average thickness (also uniform for the entire map) based on z
-        self.Davg = pcr.lookupscalar(self.lookup_table_average_thickness, z)
+        # assign average thickness (also uniform for the entire map) based on z (single precision, as PCRaster scalar maps)
+        Davg = lookup_table.get_table(self.lookup_table_average_thickness).lookup([np.float32(z)])[0]
+        self.Davg = pcr.scalar(float(Davg))
         #
-        self.report(self.Davg,"davg")
+        if self.report_sample_maps: self.report(self.Davg,"davg")
         self.lnDavg = pcr.ln(self.Davg)
       	
+        # thickness in meter
+        self.D = self.thickness(self.lnDavg)
+        
+        if self.report_sample_maps: 
+            self.report(self.D, "damc")
+        else:
+            self.update_statistics(pcr.pcr2numpy(self.D, vos.MV))
+
+    def update_statistics(self, D):
+
+        if self.statistics == None:
+            self.cells = D != vos.MV
+            self.statistics = RunningStatistics(int(self.cells.sum()))
+            if self.include_percentile and not self.percentile_by_quantile:
+                # histograms for the land cells only (the other cells have the same value in all samples)
+                land_cells = pcr.pcr2numpy(self.landmask, 0)[self.cells] == 1
+                self.histogram = LogHistogram(int(self.cells.sum()), math.log(self.minimum_depth), math.log(self.maximum_depth), \
+                                              max_samples = self.nr_samples, histogram_cells = land_cells)
+        self.statistics.update(D[self.cells])
+        if self.histogram != None: self.histogram.update(D[self.cells])
+
+    def percentiles_from_histogram(self, percentiles):
+
+        percentile_maps = {}
+        for percentile in percentiles:
+            # cells without a histogram that vary over the samples get missing values
+            values = self.histogram.percentile(percentile)
+            values[np.isnan(values)] = vos.MV
+            percentile_maps[percentile] = self.to_map(values)
+        return percentile_maps
+
+    def to_map(self, values):
+
+        # values at self.cells to a PCRaster map
+        field = np.zeros(self.cells.shape) + vos.MV
+        field[self.cells] = values
+        return pcr.numpy2pcr(pcr.Scalar, field, vos.MV)
+
+    def ln_thickness(self, lnDavg):
+
         # sedimentary basin thickness (varying over cells and samples)
-        lnD = self.F * (self.lnCV * self.lnDavg) + self.lnDavg
+        lnD = self.F * (self.lnCV * lnDavg) + lnDavg
         
         # set the minimum depth (must be bigger than zero)        
-        minimum_depth = 0.005
-        lnD = pcr.max( pcr.ln(minimum_depth), lnD)
+        lnD = pcr.max( pcr.ln(self.minimum_depth), lnD)
         
         # extrapolation 
         lnD = pcr.cover(lnD, \
-              pcr.windowaverage(lnD, 1.50*vos.getMapAttributes(self.clone_map_file,"cellsize")))
+              window_average.windowaverage(lnD, 1.50*vos.getMapAttributes(self.clone_map_file,"cellsize")))
         lnD = pcr.cover(lnD, \
-              pcr.windowaverage(pcr.cover(lnD, pcr.ln(minimum_depth)), 3.00*vos.getMapAttributes(self.clone_map_file,"cellsize")))
+              window_average.windowaverage(pcr.cover(lnD, pcr.ln(self.minimum_depth)), 3.00*vos.getMapAttributes(self.clone_map_file,"cellsize")))
         lnD = pcr.cover(lnD, \
-              pcr.windowaverage(pcr.cover(lnD, pcr.ln(minimum_depth)), 0.50))
+              window_average.windowaverage(pcr.cover(lnD, pcr.ln(self.minimum_depth)), 0.50))
         
         # smoothing per quarter arc degree
-        lnD = pcr.windowaverage(lnD, 0.25)
+        lnD = window_average.windowaverage(lnD, 0.25)
+        
+        return lnD
+
+    def thickness(self, lnDavg):
 
         # thickness in meter
-        self.D = pcr.exp(lnD)
+        D = pcr.exp(self.ln_thickness(lnDavg))
  
         #~ # smoothing  bottom elevation 
-        #~ dem_bottom = pcr.windowaverage(self.dem_average - self.D, 0.50)
+        #~ dem_bottom = pcr.windowaverage(self.dem_average - D, 0.50)
         #~ # thickness in meter
-        #~ self.D = pcr.max(0.0, self.dem_average - dem_bottom)
+        #~ D = pcr.max(0.0, self.dem_average - dem_bottom)
 
        #~ # smoothing 
-        #~ self.D = pcr.windowaverage(self.D, 1.50*vos.getMapAttributes(self.clone_map_file,"cellsize"))
+        #~ D = pcr.windowaverage(D, 1.50*vos.getMapAttributes(self.clone_map_file,"cellsize"))
         
         # accuracy until cm only
-        self.D = pcr.rounddown(self.D*100.)/100.
+        D = pcr.rounddown(D*100.)/100.
+        
+        return D
+
+    def is_monotonic_in_z(self):
+
+        # damc is non-decreasing in z in every cell if:
+        # - Davg is non-decreasing in z (table "lookup_table_average_thickness"), and
+        # - lnD = lnDavg * (1 + lnCV * F) is non-decreasing in lnDavg, i.e. 1 + lnCV * F >= 0.
+        # All other steps (maximum, cover, windowaverage, exp, rounddown) are monotonic.
+        rows = sorted(lookup_table.get_table(self.lookup_table_average_thickness).rows)
+        values = [row[4] for row in rows]
+        table_is_monotonic = all(values[i] <= values[i + 1] for i in range(len(values) - 1))
+        
+        factor_min = pcr.cellvalue(pcr.mapminimum(1.0 + self.lnCV * self.F), 1)[0]
         
-        self.report(self.D, "damc")
+        if not table_is_monotonic: logger.info("Davg is not monotonic in z.")
+        if factor_min < 0.0: logger.info("lnD is not monotonic in lnDavg (minimum of 1 + lnCV * F = "+str(factor_min)+").")
+        return table_is_monotonic and factor_min >= 0.0
+
+    def percentiles_from_quantiles(self, percentiles):
+
+        # for a monotonic model, the percentile map of damc is the map evaluated at the percentile of z
+        percentile_maps = {}
+        for percentile in percentiles:
+            z = min(5.0, max(-5.0, standard_normal.ppf(percentile)))
+            Davg = lookup_table.get_table(self.lookup_table_average_thickness).lookup([np.float32(z)])[0]
+            percentile_maps[percentile] = self.thickness(pcr.ln(pcr.scalar(float(Davg))))
+        return percentile_maps
 
     def postmcloop(self):
     
         logger.info("Step 5: Reporting the results.")
 
-        names= ["damc"]
-        mcaveragevariance(names, self.sampleNumbers(), self.timeSteps())
-        
-        if self.include_percentile:
-            percentiles = [0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
-            mcpercentiles(names, percentiles, self.sampleNumbers(), self.timeSteps())
+        percentiles = [0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+        percentile_by_quantile = self.percentile_by_quantile
 
-        #~ # debugging average values
-        #~ os.system("aguila damc-ave.001")
-        
-        self.average          = pcr.readmap("damc-ave.001")
-        self.average_variance = pcr.readmap("damc-var.001")
+        if self.report_sample_maps:
+
+            names= ["damc"]
+            mcaveragevariance(names, self.sampleNumbers(), self.timeSteps())
+            
+            if self.include_percentile and not percentile_by_quantile:
+                logger.info("The percentiles are derived from the sample maps.")
+                mcpercentiles(names, percentiles, self.sampleNumbers(), self.timeSteps())
+
+            #~ # debugging average values
+            #~ os.system("aguila damc-ave.001")
+            
+            self.average          = pcr.readmap("damc-ave.001")
+            self.average_variance = pcr.readmap("damc-var.001")
+            
+            self.total_variance = self.average_variance * self.number_of_samples
+            self.standard_deviation = (self.total_variance / (self.number_of_samples - 1.0) ) ** (0.5)
         
-        self.total_variance = self.average_variance * self.number_of_samples
-        self.standard_deviation = (self.total_variance / (self.number_of_samples - 1.0) ) ** (0.5)
+        else:
+
+            # statistics accumulated in dynamic()
+            nr_accumulated = 0 if self.statistics == None else self.statistics.count
+            if nr_accumulated != self.nr_samples:
+                msg = "Only "+str(nr_accumulated)+" of "+str(self.nr_samples)+" samples are accumulated. "
+                msg += "Forked samples require report_sample_maps = True."
+                raise RuntimeError(msg)
+            self.average            = self.to_map(self.statistics.mean)
+            self.average_variance   = self.to_map(self.statistics.variance(ddof = 0))
+            self.standard_deviation = self.to_map(np.sqrt(self.statistics.variance(ddof = 1)))
         
-        if self.include_percentile:
+        if percentile_by_quantile:
+            logger.info("The percentiles are derived from the quantiles of z.")
+            self.percentileList = percentiles
+            self.percentiles = self.percentiles_from_quantiles(percentiles)
+        elif self.include_percentile and not self.report_sample_maps:
+            logger.info("The percentiles are derived from the accumulated histograms.")
+            self.percentileList = percentiles
+            self.percentiles = self.percentiles_from_histogram(percentiles)
+        elif self.include_percentile:
             self.percentiles = {}                                                       
             self.percentileList = percentiles                                           
             for percentile in percentiles:
@@ -7,24 +7,52 @@ import datetime
 import time
 import re
 import subprocess
+import contextlib
 import netCDF4 as nc
 import numpy as np
-import pcraster as pcr
-import virtualOS as vos
+
+# missing value (as virtualOS.MV); PCRaster and virtualOS are only imported for clone maps, so that the
+# output can also be written without PCRaster from a latlonDict (e.g. benchmark_netcdf_output.py)
+MV = 1e20
+
+# fill value of variables packed to int16 (the packed values are from -32767 to 32767)
+packedFillValue = -32768
+
+def packingParameters(minimum, maximum):
+    
+    # scale_factor and add_offset for packing values from minimum to maximum to int16
+    scale_factor = (float(maximum) - float(minimum)) / (2 * 32767.)
+    add_offset   = (float(maximum) + float(minimum)) / 2.
+    return scale_factor, add_offset
+
+# cache of the cell centre coordinates of clone maps (key: file name, value: (attributes, latitudes, longitudes))
+coordinatecache = dict()
+
+def cloneCoordinates(cloneMapFileName):
+    
+    # latitudes (from high to low) and longitudes (from low to high) of the cell centres, from the clone attributes
+    import virtualOS as vos
+    attributes = vos.getMapAttributesALL(cloneMapFileName)
+    if cloneMapFileName not in coordinatecache or coordinatecache[cloneMapFileName][0] != attributes:
+        cellsize   = attributes['cellsize']
+        latitudes  = attributes['yUL'] - cellsize * (np.arange(int(attributes['rows'])) + 0.5)
+        longitudes = attributes['xUL'] + cellsize * (np.arange(int(attributes['cols'])) + 0.5)
+        coordinatecache[cloneMapFileName] = (attributes, latitudes, longitudes)
+    return coordinatecache[cloneMapFileName][1], coordinatecache[cloneMapFileName][2]
 
 class OutputNetCDF():
     
-    def __init__(self, cloneMapFileName_or_latlonDict, attributeDictionary = None):
+    def __init__(self, cloneMapFileName_or_latlonDict, attributeDictionary = None, \
+                       format = 'NETCDF3_CLASSIC', zlib = False, complevel = 4, shuffle = True, chunksizes = None, packing = None):
         		
         # cloneMap
         if isinstance( cloneMapFileName_or_latlonDict, str):
             # define latitudes and longitudes based on cloneMap
             cloneMapFileName = cloneMapFileName_or_latlonDict
+            import pcraster as pcr
             pcr.setclone(cloneMapFileName)
-            cloneMap = pcr.boolean(1.0)
-            # latitudes and longitudes
-            self.latitudes  = np.unique(pcr.pcr2numpy(pcr.ycoordinate(cloneMap), vos.MV))[::-1]
-            self.longitudes = np.unique(pcr.pcr2numpy(pcr.xcoordinate(cloneMap), vos.MV))
+            # latitudes and longitudes (cached per clone)
+            self.latitudes, self.longitudes = cloneCoordinates(cloneMapFileName)
         else:
             # define latitudes and longitudes based on latlonDict       # NOT TESTED YET
             latlonDict = cloneMapFileName_or_latlonDict
@@ -36,7 +64,19 @@ class OutputNetCDF():
         if self.longitudes[-1] < self.longitudes[0]: self.longitudes = self.longitudes[::-1]
         
         # netcdf format:
-        self.format = 'NETCDF3_CLASSIC'
+        self.format = format
+        
+        # compression and chunking of the variables (NETCDF4 formats only):
+        # - zlib (deflate) with complevel (1-9) and the shuffle filter, 
+        # - chunksizes: (lat, lon) chunk shape (None: default chunking), e.g. (256, 256) for windowed reading
+        self.zlib       = zlib and self.format.startswith('NETCDF4')
+        self.complevel  = complevel
+        self.shuffle    = shuffle
+        self.chunksizes = chunksizes if self.format.startswith('NETCDF4') else None
+        
+        # packing to int16 with scale_factor and add_offset (key: variable name, value: (minimum, maximum)); 
+        # values outside the range are clipped
+        self.packing = {} if packing == None else packing
         
         self.attributeDictionary = {}
         if attributeDictionary == None:
@@ -50,9 +90,73 @@ class OutputNetCDF():
         else:
             self.attributeDictionary = attributeDictionary
         
+        # dataset of the current writer session (see session)
+        self.sessionFileName = None
+        self.sessionDataset  = None
+        
+    @contextlib.contextmanager
+    def session(self, ncFileName, mode = 'w'):
+        
+        # All calls for ncFileName within the session (with statement) use one dataset, opened once and closed
+        # at the end, e.g.: 
+        #   with output.session(ncFileName):
+        #       output.createNetCDF(ncFileName, varNames, varUnits)     # define all variables first, then
+        #       output.data2NetCDF(ncFileName, varNames, varFields)     # write each variable once
+        # Defining variables after data have been written (e.g. addNewVariable) may rewrite the entire file.
+        self.openSession(ncFileName, mode)
+        try:
+            yield self
+        finally:
+            self.closeSession()
+
+    def openSession(self, ncFileName, mode = 'w'):
+        
+        # start of a session that is ended by closeSession (e.g. for sessions spanning tasks of a background writer) 
+        self.sessionDataset  = nc.Dataset(ncFileName, mode, format = self.format)
+        self.sessionFileName = ncFileName
+
+    def closeSession(self):
+        
+        if self.sessionDataset == None: return
+        self.sessionDataset.sync()
+        self.sessionDataset.close()
+        self.sessionDataset  = None
+        self.sessionFileName = None
+
+    def openDataset(self, ncFileName, mode):
+        
+        # the dataset of the session, or a dataset that is closed by closeDataset
+        if self.sessionDataset != None and ncFileName == self.sessionFileName: return self.sessionDataset
+        return nc.Dataset(ncFileName, mode, format = self.format)
+
+    def closeDataset(self, rootgrp):
+        
+        if rootgrp is self.sessionDataset: return
+        rootgrp.sync()
+        rootgrp.close()
+
+    def createDataVariable(self,rootgrp,shortVarName,timeAttribute=None):
+
+        dimensions = ('lat','lon',)
+        chunksizes = None
+        if self.chunksizes != None:
+            chunksizes = (min(self.chunksizes[0], len(self.latitudes)), min(self.chunksizes[1], len(self.longitudes)))
+        if timeAttribute != None:
+            dimensions = ('time',) + dimensions
+            if chunksizes != None: chunksizes = (1,) + chunksizes
+        
+        if shortVarName in self.packing:
+            var = rootgrp.createVariable(shortVarName,'i2',dimensions,fill_value=packedFillValue,zlib=self.zlib,\
+                                         complevel=self.complevel,shuffle=self.shuffle,chunksizes=chunksizes)
+            var.scale_factor, var.add_offset = packingParameters(*self.packing[shortVarName])
+        else:
+            var = rootgrp.createVariable(shortVarName,'f4',dimensions,fill_value=MV,zlib=self.zlib,\
+                                         complevel=self.complevel,shuffle=self.shuffle,chunksizes=chunksizes)
+        return var
+
     def createNetCDF(self,ncFileName,varName,varUnit=None,varLongName=None,timeAttribute=None):
 
-        rootgrp= nc.Dataset(ncFileName,'w',format= self.format)
+        rootgrp= self.openDataset(ncFileName,'w')
 
         #-create dimensions - time is unlimited, others are fixed
         rootgrp.createDimension('lat',len(self.latitudes))
@@ -93,22 +197,18 @@ class OutputNetCDF():
             longVarName  = varLongName[i]                                                                                                                                          
             unitVar      = varUnit[i]                                                                                                                                                  
             if unitVar == None: unitVar = 'undefined'                                                                                                                                                  
-            if timeAttribute != None:                                                                                                                                                  
-                var= rootgrp.createVariable(shortVarName,'f4',('time','lat','lon',) ,fill_value=vos.MV,zlib=False)                                                                      
-            else:                                                                                                                                                                      
-                var= rootgrp.createVariable(shortVarName,'f4',('lat','lon',) ,fill_value=vos.MV,zlib=False)                                                                             
+            var= self.createDataVariable(rootgrp,shortVarName,timeAttribute)
             var.standard_name = shortVarName                                                                                                                                           
             var.long_name = longVarName                                                                                                                                                
             var.units = unitVar
 
         for k, v in self.attributeDictionary.items(): setattr(rootgrp,k,v)
 
-        rootgrp.sync()
-        rootgrp.close()
+        self.closeDataset(rootgrp)
 
     def addNewVariable(self,ncFileName,varName,varUnit=None,varLongName=None,timeAttribute=None):
 
-        rootgrp= nc.Dataset(ncFileName,'a',format= self.format)
+        rootgrp= self.openDataset(ncFileName,'a')
 
         # variable short and long names
         if isinstance(varName,list) == False: varName = [varName] 
@@ -124,31 +224,26 @@ class OutputNetCDF():
             longVarName  = varLongName[i]                                                                                                                                          
             unitVar      = varUnit[i]                                                                                                                                                  
             if unitVar == None: unitVar = 'undefined'                                                                                                                                                  
-            if timeAttribute != None:                                                                                                                                                  
-                var = rootgrp.createVariable(shortVarName,'f4',('time','lat','lon',) ,fill_value=vos.MV,zlib=False)                                                                      
-            else:                                                                                                                                                                      
-                var = rootgrp.createVariable(shortVarName,'f4',('lat','lon',) ,fill_value=vos.MV,zlib=False)                                                                             
+            var = self.createDataVariable(rootgrp,shortVarName,timeAttribute)
             var.standard_name = shortVarName                                                                                                                                           
             var.long_name = longVarName                                                                                                                                                
             var.units = unitVar
 
-        rootgrp.sync()
-        rootgrp.close()
+        self.closeDataset(rootgrp)
 
     def changeAtrribute(self,ncFileName,attributeDictionary):
 
-        rootgrp= nc.Dataset(ncFileName,'a',format= self.format)
+        rootgrp= self.openDataset(ncFileName,'a')
 
         for k, v in attributeDictionary.items():
           setattr(rootgrp,k,v)
 
-        rootgrp.sync()
-        rootgrp.close()
+        self.closeDataset(rootgrp)
 
     def data2NetCDF(self,ncFile,varName,varField,timeStamp=None,posCnt=None):
 
         #-write data to netCDF
-        rootgrp= nc.Dataset(ncFile,'a')    
+        rootgrp= self.openDataset(ncFile,'a')    
 
         if isinstance(varName,list) == False: varName = [varName] 
         if isinstance(varField,list) == False: varField = [varField]
@@ -161,10 +256,15 @@ class OutputNetCDF():
 
         for i in range(0, len(varName)):
             shortVarName = varName[i]
+            field = varField[i]
+            if shortVarName in self.packing:
+                # missing values are written as the packed fill value
+                field = np.ma.masked_values(field, MV)
+                field = np.ma.clip(field, *self.packing[shortVarName])
+                field.set_fill_value(packedFillValue)
             if timeStamp != None:                                                                                                                                                  
-                rootgrp.variables[shortVarName][posCnt,:,:] = varField[i]                                                                      
+                rootgrp.variables[shortVarName][posCnt,:,:] = field                                                                      
             else:                                                                                                                                                                      
-                rootgrp.variables[shortVarName][:,:]        = varField[i]
+                rootgrp.variables[shortVarName][:,:]        = field
 
-        rootgrp.sync()
-        rootgrp.close()
+        self.closeDataset(rootgrp)
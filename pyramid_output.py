@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Multi-resolution pyramid of fields (2D arrays with vos.MV as missing value) from a single pass over the fine grid:
+# each coarser level stores, per field, the sum and the number of the (non missing) fine cells of its cells and is
+# aggregated from the coarsest existing level with a factor that divides its factor (e.g. 5 arc min -> 15 -> 30 -> 60).
+# The averages are the averages of the fine cells (as vos.regridToCoarse(..., "average")), whatever the path.
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+import virtualOS as vos
+
+def blockSum(values, factor):
+
+    # sum of the blocks of factor x factor cells; incomplete blocks at the bottom and right edges are dropped 
+    # (as in vos.regridToCoarse)
+    rows = values.shape[0] // factor
+    cols = values.shape[1] // factor
+    return values[:rows * factor, :cols * factor].reshape(rows, factor, cols, factor).sum(axis = 3).sum(axis = 1)
+
+class ResolutionPyramid(object):
+
+    def __init__(self, fields, cellsize):
+
+        object.__init__(self)
+
+        # fields at the fine level (key: name, value: 2D array with vos.MV as missing value) and its cell size
+        self.fields   = fields
+        self.cellsize = cellsize
+
+        # coarser levels (key: factor, value: {name: (sum, count)})
+        self.levels = {}
+
+    def factor(self, cellsize):
+
+        factor = int(round(float(cellsize) / self.cellsize))
+        if factor < 1 or abs(factor * self.cellsize - cellsize) > 1e-6 * cellsize:
+            raise ValueError("The cell size "+str(cellsize)+" is not a multiple of the fine cell size "+str(self.cellsize)+".")
+        return factor
+
+    def sums(self, factor, name):
+
+        # (sum, count) of the fine cells per cell of the level
+        if factor == 1:
+            valid = self.fields[name] != vos.MV
+            return np.where(valid, self.fields[name].astype(np.float64), 0.0), valid.astype(np.int32)
+        return self.levels[factor][name]
+
+    def build(self, cellsizes):
+
+        # all levels, from fine to coarse
+        for factor in sorted(set(self.factor(cellsize) for cellsize in cellsizes)):
+            if factor == 1 or factor in self.levels: continue
+            source = max(level for level in [1] + list(self.levels.keys()) if factor % level == 0)
+            logger.info("Aggregating the level with a cell size of "+str(factor * self.cellsize)+\
+                        " from the level with a cell size of "+str(source * self.cellsize))
+            self.levels[factor] = {}
+            for name in self.fields:
+                value_sum, count = self.sums(source, name)
+                self.levels[factor][name] = (blockSum(value_sum, factor // source), blockSum(count, factor // source))
+
+    def average(self, cellsize, name):
+
+        # averages at the level of cellsize (2D array with vos.MV as missing value)
+        factor = self.factor(cellsize)
+        if factor == 1: return self.fields[name]
+        if factor not in self.levels: self.build([cellsize])
+        value_sum, count = self.levels[factor][name]
+        average = np.zeros(count.shape) + vos.MV
+        average[count > 0] = value_sum[count > 0] / count[count > 0]
+        return average
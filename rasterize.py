@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# In-process rasterization of a shapefile attribute onto a clone grid (as gdal_rasterize -a attribute -te ... -tr ...),
+# with an optional cache of the rasterized (integer) grids, keyed by the shapefile content and the clone geometry.
+
+import os
+import hashlib
+import numpy as np
+
+from osgeo import gdal, ogr
+
+import logging
+logger = logging.getLogger(__name__)
+
+shapefile_extensions = [".shp", ".shx", ".dbf", ".prj", ".cpg"]
+
+def cache_key(shapefile, attribute, clone_map_attr):
+
+    # sha1 of the shapefile components, the attribute and the clone geometry
+    key = hashlib.sha1()
+    base = os.path.splitext(shapefile)[0]
+    for extension in shapefile_extensions:
+        if not os.path.exists(base + extension): continue
+        key.update(extension.encode())
+        with open(base + extension, "rb") as component:
+            for block in iter(lambda: component.read(1 << 20), b""): key.update(block)
+    key.update(str(attribute).encode())
+    for name in ['xUL', 'yUL', 'cellsize', 'rows', 'cols']:
+        key.update(repr(float(clone_map_attr[name])).encode())
+    return key.hexdigest()
+
+def rasterize_shapefile(shapefile, attribute, clone_map_attr):
+
+    # rasterize into a memory dataset (Float64, initialized with 0 and without a missing value, as gdal_rasterize)
+    rows, cols = int(clone_map_attr['rows']), int(clone_map_attr['cols'])
+    cellsize   = clone_map_attr['cellsize']
+    raster = gdal.GetDriverByName("MEM").Create("", cols, rows, 1, gdal.GDT_Float64)
+    raster.SetGeoTransform((clone_map_attr['xUL'], cellsize, 0.0, clone_map_attr['yUL'], 0.0, - cellsize))
+    raster.GetRasterBand(1).Fill(0.0)
+
+    source = ogr.Open(str(shapefile))
+    if source is None: raise IOError("Cannot open the shapefile "+str(shapefile))
+    layer = source.GetLayer()
+    error = gdal.RasterizeLayer(raster, [1], layer, options = ["ATTRIBUTE="+str(attribute)])
+    if error != 0: raise RuntimeError("Rasterizing "+str(shapefile)+" failed (error code "+str(error)+").")
+
+    # nominal values
+    return raster.GetRasterBand(1).ReadAsArray().astype(np.int32)
+
+def rasterize(shapefile, attribute, clone_map_attr, cache_directory = None):
+
+    # rasterized values (2D integer array) at the clone grid, from the cache if available
+    if cache_directory is None: return rasterize_shapefile(shapefile, attribute, clone_map_attr)
+
+    cache_file = os.path.join(cache_directory, "rasterized_"+cache_key(shapefile, attribute, clone_map_attr)+".npz")
+    if os.path.exists(cache_file):
+        logger.info("Reading the rasterized "+str(shapefile)+" from the cache file "+cache_file)
+        return np.load(cache_file)['values']
+
+    values = rasterize_shapefile(shapefile, attribute, clone_map_attr)
+    if not os.path.exists(cache_directory): os.makedirs(cache_directory)
+    # write to a temporary file first, so that an interrupted run does not leave a corrupt cache file
+    temporary_file = cache_file[:-len(".npz")] + "." + str(os.getpid()) + ".npz"
+    np.savez_compressed(temporary_file, values = values)
+    os.rename(temporary_file, cache_file)
+    logger.info("The rasterized "+str(shapefile)+" is stored in the cache file "+cache_file)
+    return values
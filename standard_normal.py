@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Functions related to the standard normal variate z that drives the Monte Carlo simulation of aquifer thickness.
+
+import os
+import math
+import struct
+import hashlib
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+def cdf(x):
+
+    # cumulative distribution function of the standard normal distribution
+    if x == float("inf") : return 1.0
+    if x == float("-inf"): return 0.0
+    return 0.5 * math.erfc(- x / math.sqrt(2.0))
+
+def contains(value, lower, lower_closed, upper, upper_closed):
+
+    # whether the interval contains value
+    above_lower = value > lower or (value == lower and lower_closed)
+    below_upper = value < upper or (value == upper and upper_closed)
+    return above_lower and below_upper
+
+def new_seed():
+
+    # a random seed for a run (to be logged, so that the run can be reproduced)
+    return struct.unpack("<Q", os.urandom(8))[0] >> 1
+
+class Stream(object):
+
+    # Counter-based random stream keyed by the run seed and a number (sample number, or 0 for the run itself):
+    # the i-th uniform value is taken from the sha256 hash of (seed, number, i), so that the values of a stream
+    # do not depend on the other streams (nor on the Python/NumPy version).
+
+    def __init__(self, seed, number):
+
+        object.__init__(self)
+
+        self.key     = struct.pack("<QQ", int(seed) % 2**64, int(number) % 2**64)
+        self.counter = 0
+
+    def random(self):
+
+        # uniform value in [0, 1), with 53 random bits
+        digest = hashlib.sha256(self.key + struct.pack("<Q", self.counter)).digest()
+        self.counter += 1
+        return (struct.unpack("<Q", digest[0:8])[0] >> 11) * 2.0**-53
+
+    def standard_normal(self):
+
+        # Box-Muller transform
+        radius = math.sqrt(-2.0 * math.log(1.0 - self.random()))
+        return radius * math.cos(2.0 * math.pi * self.random())
+
+    def permutation(self, number):
+
+        # random permutation of range(number) (Fisher-Yates shuffle)
+        permutation = np.arange(number)
+        for i in range(number - 1, 0, -1):
+            j = int(self.random() * (i + 1))
+            permutation[i], permutation[j] = permutation[j], permutation[i]
+        return permutation
+
+def stream(seed, number):
+
+    return Stream(seed, number)
+
+def draw(sample_numbers, seed):
+
+    # standard normal values, one per sample, from the streams keyed by the run seed and the sample number;
+    # the value of a sample does not depend on the other samples, nor on how the samples are distributed over processes
+    z = np.empty(len(sample_numbers))
+    for i, sample in enumerate(sample_numbers):
+        z[i] = stream(seed, sample).standard_normal()
+    return z
+
+# sampling schemes for z (sample numbers start at 1):
+# - plain     : random sampling
+# - stratified: sample i is drawn from the i-th of number_of_samples equiprobable strata
+# - lhs       : Latin hypercube sampling; for the single variate z, this is stratified sampling with the strata
+#               randomly assigned to the samples (so that any subset of samples is spread over the distribution)
+# - sobol     : the (one dimensional) Sobol sequence, i.e. the van der Corput sequence in base 2, randomly shifted
+sampling_schemes = ["plain", "stratified", "lhs", "sobol"]
+
+def radical_inverse(index):
+
+    # van der Corput sequence in base 2
+    inverse, factor = 0.0, 0.5
+    while index > 0:
+        inverse += factor * (index & 1)
+        index  >>= 1
+        factor  *= 0.5
+    return inverse
+
+def sample(sample_numbers, number_of_samples, seed, sampling = "plain"):
+
+    if sampling == "plain": return draw(sample_numbers, seed)
+    if sampling not in sampling_schemes:
+        raise ValueError("Unknown sampling option: "+str(sampling))
+
+    if sampling == "lhs": strata = stream(seed, 0).permutation(number_of_samples)
+    if sampling == "sobol": shift = stream(seed, 0).random()
+
+    z = np.empty(len(sample_numbers))
+    for i, number in enumerate(sample_numbers):
+        if sampling == "stratified":
+            u = (number - 1 + stream(seed, number).random()) / number_of_samples
+        if sampling == "lhs":
+            u = (strata[number - 1] + stream(seed, number).random()) / number_of_samples
+        if sampling == "sobol":
+            u = (radical_inverse(number - 1) + shift) % 1.0
+        z[i] = ppf(u)
+    return z
+
+def interval_probability(lower, lower_closed, upper, upper_closed, z_min = -5.0, z_max = 5.0):
+
+    # probability that z, clamped to [z_min, z_max], is within the interval
+
+    # continuous part (within <z_min, z_max>)
+    probability = max(0.0, cdf(min(upper, z_max)) - cdf(max(lower, z_min)))
+
+    # point masses at z_min and z_max (from clamping)
+    if contains(z_min, lower, lower_closed, upper, upper_closed): probability += cdf(z_min)
+    if contains(z_max, lower, lower_closed, upper, upper_closed): probability += 1.0 - cdf(z_max)
+
+    return probability
+
+def ppf(p):
+
+    # inverse of the cumulative distribution function (quantile function), by bisection
+    if p <= 0.0: return float("-inf")
+    if p >= 1.0: return float("inf")
+    lower, upper = -40.0, 40.0
+    for i in range(200):
+        middle = 0.5 * (lower + upper)
+        if middle == lower or middle == upper: break
+        if cdf(middle) < p:
+            lower = middle
+        else:
+            upper = middle
+    return upper
@@ -8,10 +8,13 @@ import subprocess
 import datetime
 import random
 import os
-import gc
 import re
 import math
 import sys
+import struct
+import collections
+import threading
+import functools
 
 import netCDF4 as nc
 import numpy as np
@@ -25,9 +28,164 @@ logger = logging.getLogger(__name__)
 MV = 1e20
 smallNumber = 1E-39
 
-# file cache to minimize/reduce opening/closing files.  
-filecache = dict()
+# lock for the netCDF library (which is not thread safe), e.g. for reading while a background writer 
+# (see background_writer.py) writes netCDF files; re-entrant, so that locked functions may call each other 
+netcdf_lock = threading.RLock()
+
+def withNetCDFLock(function):
+    # decorator: the function is executed while holding netcdf_lock
+    @functools.wraps(function)
+    def locked(*args, **kwargs):
+        with netcdf_lock:
+            return function(*args, **kwargs)
+    return locked
+
+class NetCDFHandlePool(object):
+    # Pool of netCDF datasets opened for reading, to minimize/reduce opening/closing files:
+    # - at most maxSize datasets are open; the least recently used dataset is closed first,
+    # - datasets inherited from another process (e.g. after a fork) are not used (nor closed), but reopened,
+    # - the numbers of hits, misses and evictions are counted.
+    
+    def __init__(self, maxSize = 16):
+        object.__init__(self)
+        self.maxSize   = maxSize
+        self.handles   = collections.OrderedDict()          # key: file name, value: dataset (least recently used first)
+        self.pid       = os.getpid()
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+    
+    @withNetCDFLock
+    def get(self, ncFile):
+        if self.pid != os.getpid():
+            # a forked (worker) process: the handles of the parent process must not be used (or closed) here 
+            self.handles = collections.OrderedDict()
+            self.pid = os.getpid()
+        if ncFile in self.handles:
+            self.hits += 1
+            f = self.handles.pop(ncFile)
+        else:
+            self.misses += 1
+            logger.debug('Opening the netcdf file: '+str(ncFile))
+            f = nc.Dataset(ncFile)
+        self.handles[ncFile] = f
+        while len(self.handles) > max(1, self.maxSize):
+            self.evictions += 1
+            oldFile, oldHandle = self.handles.popitem(last = False)
+            logger.debug('Closing the netcdf file: '+str(oldFile))
+            oldHandle.close()
+        return f
+    
+    @withNetCDFLock
+    def evict(self, ncFile):
+        # close a file (e.g. before it is written)
+        if self.pid == os.getpid() and ncFile in self.handles:
+            self.evictions += 1
+            self.handles.pop(ncFile).close()
+    
+    @withNetCDFLock
+    def clear(self):
+        for ncFile in list(self.handles.keys()): self.evict(ncFile)
+    
+    def statistics(self):
+        return {'open': len(self.handles), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+# pool of the netCDF files that are read by the functions below 
+netcdfpool = NetCDFHandlePool()
+
+# cache of the grid definitions of netCDF files (key: file name, value: (modification time, grid definition))
+gridcache = dict()
+
+def getNetCDFGrid(ncFile,f):
+    # cell size, size, upper left corner and orientation of the (regular) lat/lon grid of a netCDF file, 
+    # from the first coordinate values only (with the same arithmetic as the cropping in the readers below)
+    modificationTime = os.path.getmtime(ncFile)
+    if ncFile in gridcache and gridcache[ncFile][0] == modificationTime:
+        return gridcache[ncFile][1]
+    lat = f.variables['lat'] if 'lat' in f.variables else f.variables['latitude']
+    lon = f.variables['lon'] if 'lon' in f.variables else f.variables['longitude']
+    grid = {}
+    grid['rows'] = len(lat)
+    grid['cols'] = len(lon)
+    # orientation: north up (latitudes decreasing) or south up 
+    grid['northUp'] = bool(lat[0] > lat[1])
+    if grid['northUp']:
+        grid['cellsize'] = float(lat[0]- lat[1])
+        grid['yUL'] = lat[0]+0.5*grid['cellsize']
+    else:
+        grid['cellsize'] = float(lat[1]- lat[0])
+        grid['yUL'] = lat[grid['rows']-1]+0.5*grid['cellsize']
+    grid['xUL'] = lon[0]-0.5*grid['cellsize']
+    gridcache[ncFile] = (modificationTime, grid)
+    return grid
+
+# cache of the time axes of netCDF files (key: file name, value: (modification time, time axis))
+timecache = dict()
+
+def getNetCDFTimeAxis(ncFile,f):
+    # numeric time values, units and calendar of a netCDF file, and a lookup table (time value -> index)
+    modificationTime = os.path.getmtime(ncFile)
+    if ncFile in timecache and timecache[ncFile][0] == modificationTime:
+        return timecache[ncFile][1]
+    nctime = f.variables['time']  # A netCDF time variable object.
+    timeAxis = {}
+    timeAxis['values']   = np.asarray(nctime[:], dtype = np.float64)
+    timeAxis['units']    = nctime.units
+    timeAxis['calendar'] = getattr(nctime, 'calendar', 'standard')
+    timeAxis['index']    = dict((value, index) for index, value in enumerate(timeAxis['values'].tolist()))
+    timecache[ncFile] = (modificationTime, timeAxis)
+    return timeAxis
+
+def getNetCDFTimeIndex(ncFile,f,date):
+    # time index of date (as nc.date2index) and the selection used: 'exact', or else 'before' (the last time 
+    # before the date) or 'after' (the first time after the date), found with a binary search (increasing times)
+    timeAxis = getNetCDFTimeAxis(ncFile,f)
+    value = float(nc.date2num(date, timeAxis['units'], calendar = timeAxis['calendar']))
+    if value in timeAxis['index']:
+        return timeAxis['index'][value], 'exact'
+    idx = int(np.searchsorted(timeAxis['values'], value, side = 'right')) - 1
+    if idx >= 0:
+        return idx, 'before'
+    idx = int(np.searchsorted(timeAxis['values'], value, side = 'left'))
+    if idx < len(timeAxis['values']):
+        return idx, 'after'
+    raise ValueError("No time index for "+str(date)+" in the netcdf file: "+str(ncFile))
+
+def isSameNetCDFGrid(grid,attributeClone):
+    # whether the clone and the netCDF grid have the same attributes
+    return attributeClone['cellsize'] == grid['cellsize'] and \
+           attributeClone['rows']     == grid['rows']     and \
+           attributeClone['cols']     == grid['cols']     and \
+           attributeClone['xUL']      == grid['xUL']      and \
+           attributeClone['yUL']      == grid['yUL']
+
+def getNetCDFCropIndices(grid,attributeClone):
+    # rows and columns (north up) of the netCDF grid covering the clone: the start is the cell (center) nearest to 
+    # the upper left cell of the clone, the size follows from the cell size ratio
+    cellsizeInput = grid['cellsize']
+    cellsizeClone = attributeClone['cellsize']
+    xIdxSta = int(min(grid['cols'] - 1, max(0, round((attributeClone['xUL'] - grid['xUL']) / cellsizeInput))))
+    xIdxEnd = int(math.ceil(xIdxSta + attributeClone['cols'] /(cellsizeInput/cellsizeClone)))
+    yIdxSta = int(min(grid['rows'] - 1, max(0, round((grid['yUL'] - attributeClone['yUL']) / cellsizeInput))))
+    yIdxEnd = int(math.ceil(yIdxSta + attributeClone['rows'] /(cellsizeInput/cellsizeClone)))
+    return yIdxSta,yIdxEnd,xIdxSta,xIdxEnd
+
+def readNetCDFHyperslab(var,grid,idx=None,yIdxSta=0,yIdxEnd=None,xIdxSta=0,xIdxEnd=None):
+    # read only the rows/columns (north up) of a 2D variable, or of the time index idx of a 3D variable 
+    # (the first time index if idx is None)
+    if yIdxEnd == None: yIdxEnd = grid['rows']
+    if xIdxEnd == None: xIdxEnd = grid['cols']
+    yIdxEnd = min(yIdxEnd, grid['rows'])
+    rows = slice(yIdxSta,yIdxEnd)
+    if grid['northUp'] == False: rows = slice(grid['rows'] - yIdxEnd, grid['rows'] - yIdxSta)
+    if var.ndim == 3:
+        data = var[0 if idx == None else idx,rows,xIdxSta:xIdxEnd]
+    else:
+        data = var[rows,xIdxSta:xIdxEnd]
+    if grid['northUp'] == False: data = data[::-1,:]
+    return data
 
+@withNetCDFLock
 def netcdf2PCRobjCloneWithoutTime(ncFile,varName,
                                   cloneMapFileName  = None,\
                                   LatitudeLongitude = False,\
@@ -41,68 +199,30 @@ def netcdf2PCRobjCloneWithoutTime(ncFile,varName,
     #     Only works if cells are 'square'.
     #     Only works if cellsizeClone <= cellsizeInput
     # Get netCDF file and variable name:
-    if ncFile in filecache.keys():
-        f = filecache[ncFile]
-        print "Cached: ", ncFile
-    else:
-        f = nc.Dataset(ncFile)
-        filecache[ncFile] = f
-        print "New: ", ncFile
+    f = netcdfpool.get(ncFile)
     
-    #print ncFile
-    #f = nc.Dataset(ncFile)  
+    # (lat/latitude and lon/longitude coordinates are resolved by getNetCDFGrid)
     varName = str(varName)
     
-    if LatitudeLongitude == True:
-        try:
-            f.variables['lat'] = f.variables['latitude']
-            f.variables['lon'] = f.variables['longitude']
-        except:
-            pass
+    # grid definition of the input (netCDF), cached per file
+    grid = getNetCDFGrid(ncFile,f)
     
     sameClone = True
     # check whether clone and input maps have the same attributes:
     if cloneMapFileName != None:
         # get the attributes of cloneMap
         attributeClone = getMapAttributesALL(cloneMapFileName)
-        cellsizeClone = attributeClone['cellsize']
-        rowsClone = attributeClone['rows']
-        colsClone = attributeClone['cols']
-        xULClone = attributeClone['xUL']
-        yULClone = attributeClone['yUL']
-        # get the attributes of input (netCDF) 
-        cellsizeInput = f.variables['lat'][0]- f.variables['lat'][1]
-        cellsizeInput = float(cellsizeInput)
-        rowsInput = len(f.variables['lat'])
-        colsInput = len(f.variables['lon'])
-        xULInput = f.variables['lon'][0]-0.5*cellsizeInput
-        yULInput = f.variables['lat'][0]+0.5*cellsizeInput
-        # check whether both maps have the same attributes 
-        if cellsizeClone != cellsizeInput: sameClone = False
-        if rowsClone != rowsInput: sameClone = False
-        if colsClone != colsInput: sameClone = False
-        if xULClone != xULInput: sameClone = False
-        if yULClone != yULInput: sameClone = False
+        sameClone = isSameNetCDFGrid(grid,attributeClone)
 
-    try:
-        cropData = f.variables[varName][0][:,:]       # still original data
-    except:
-        cropData = f.variables[varName][:,:]          # still original data
     factor = 1                                        # needed in regridData2FinerGrid
     #
     if sameClone == False:
-        # crop to cloneMap:
-        minX    = min(abs(f.variables['lon'][:] - (xULClone + 0.5*cellsizeInput))) # ; print(minX)
-        xIdxSta = int(np.where(abs(f.variables['lon'][:] - (xULClone + 0.5*cellsizeInput)) == minX)[0])
-        xIdxEnd = int(math.ceil(xIdxSta + colsClone /(cellsizeInput/cellsizeClone)))
-        minY    = min(abs(f.variables['lat'][:] - (yULClone - 0.5*cellsizeInput))) # ; print(minY)
-        yIdxSta = int(np.where(abs(f.variables['lat'][:] - (yULClone - 0.5*cellsizeInput)) == minY)[0])
-        yIdxEnd = int(math.ceil(yIdxSta + rowsClone /(cellsizeInput/cellsizeClone)))
-        try:
-            cropData = f.variables[varName][yIdxSta:yIdxEnd,xIdxSta:xIdxEnd]
-        except:
-            cropData = f.variables[varName][0][yIdxSta:yIdxEnd,xIdxSta:xIdxEnd]
-        factor = int(round(float(cellsizeInput)/float(cellsizeClone)))
+        # crop to cloneMap (only the hyperslab covering the clone is read):
+        yIdxSta,yIdxEnd,xIdxSta,xIdxEnd = getNetCDFCropIndices(grid,attributeClone)
+        cropData = readNetCDFHyperslab(f.variables[varName],grid,None,yIdxSta,yIdxEnd,xIdxSta,xIdxEnd)
+        factor = int(round(float(grid['cellsize'])/float(attributeClone['cellsize'])))
+    else:
+        cropData = readNetCDFHyperslab(f.variables[varName],grid)
     
     # convert to PCR object and close f
     if specificFillValue != None:
@@ -124,6 +244,7 @@ def netcdf2PCRobjCloneWithoutTime(ncFile,varName,
     # PCRaster object
     return (outPCR)
 
+@withNetCDFLock
 def netcdf2PCRobjClone(ncFile,varName,dateInput,\
                        useDoy = None,
                        cloneMapFileName  = None,\
@@ -140,28 +261,13 @@ def netcdf2PCRobjClone(ncFile,varName,dateInput,\
     
     logger.info('reading variable: '+str(varName)+' from the file: '+str(ncFile))
     
-    if ncFile in filecache.keys():
-        f = filecache[ncFile]
-        print "Cached: ", ncFile
-    else:
-        f = nc.Dataset(ncFile)
-        filecache[ncFile] = f
-        print "New: ", ncFile
+    f = netcdfpool.get(ncFile)
     
+    # (lat/latitude and lon/longitude coordinates are resolved by getNetCDFGrid)
     varName = str(varName)
     
-    if LatitudeLongitude == True:
-        try:
-            f.variables['lat'] = f.variables['latitude']
-            f.variables['lon'] = f.variables['longitude']
-        except:
-            pass
-    
-    if varName == "evapotranspiration":        
-        try:
-            f.variables['evapotranspiration'] = f.variables['referencePotET']
-        except:
-            pass
+    if varName == "evapotranspiration" and 'referencePotET' in f.variables:        
+        varName = 'referencePotET'
 
     # date
     date = dateInput
@@ -175,76 +281,44 @@ def netcdf2PCRobjClone(ncFile,varName,dateInput,\
         if useDoy == "month":
             idx = int(date.month) - 1
         else:
-            nctime = f.variables['time']  # A netCDF time variable object.
             if useDoy == "yearly":\
                 date = datetime.datetime(date.year,int(1),int(1))
             if useDoy == "monthly":\
                 date = datetime.datetime(date.year,date.month,int(1))
-            try:
-                idx = nc.date2index(date, nctime, calendar = nctime.calendar, \
-                                                  select='exact')
-            except:                                  
-                try:
-                    idx = nc.date2index(date, nctime, calendar = nctime.calendar, \
-                                                      select='before')
-                    msg  = "\n"
-                    msg += "WARNING related to the netcdf file: "+str(ncFile)+" ; variable: "+str(varName)+" !!!!!!"+"\n"
-                    msg += "No "+str(dateInput)+" is available. The 'before' option is used while selecting netcdf time."
-                    msg += "\n"
-                except:
-                    idx = nc.date2index(date, nctime, calendar = nctime.calendar, \
-                                                      select='after')
-                    msg  = "\n"
-                    msg += "WARNING related to the netcdf file: "+str(ncFile)+" ; variable: "+str(varName)+" !!!!!!"+"\n"
-                    msg += "No "+str(dateInput)+" is available. The 'after' option is used while selecting netcdf time."
-                    msg += "\n"
+            # time axis of the file, cached per file
+            idx, select = getNetCDFTimeIndex(ncFile,f,date)
+            if select != 'exact':
+                msg  = "\n"
+                msg += "WARNING related to the netcdf file: "+str(ncFile)+" ; variable: "+str(varName)+" !!!!!!"+"\n"
+                msg += "No "+str(dateInput)+" is available. The '"+select+"' option is used while selecting netcdf time."
+                msg += "\n"
                 logger.info(msg)                                   
                                                   
     idx = int(idx)                                                  
 
+    # grid definition of the input (netCDF), cached per file
+    grid = getNetCDFGrid(ncFile,f)
+    
     sameClone = True
     # check whether clone and input maps have the same attributes:
     if cloneMapFileName != None:
         # get the attributes of cloneMap
         attributeClone = getMapAttributesALL(cloneMapFileName)
-        cellsizeClone = attributeClone['cellsize']
-        rowsClone = attributeClone['rows']
-        colsClone = attributeClone['cols']
-        xULClone = attributeClone['xUL']
-        yULClone = attributeClone['yUL']
-        # get the attributes of input (netCDF) 
-        cellsizeInput = f.variables['lat'][0]- f.variables['lat'][1]
-        cellsizeInput = float(cellsizeInput)
-        rowsInput = len(f.variables['lat'])
-        colsInput = len(f.variables['lon'])
-        xULInput = f.variables['lon'][0]-0.5*cellsizeInput
-        yULInput = f.variables['lat'][0]+0.5*cellsizeInput
-        # check whether both maps have the same attributes 
-        if cellsizeClone != cellsizeInput: sameClone = False
-        if rowsClone != rowsInput: sameClone = False
-        if colsClone != colsInput: sameClone = False
-        if xULClone != xULInput: sameClone = False
-        if yULClone != yULInput: sameClone = False
+        sameClone = isSameNetCDFGrid(grid,attributeClone)
 
-    cropData = f.variables[varName][int(idx),:,:]       # still original data
     factor = 1                          # needed in regridData2FinerGrid
 
     if sameClone == False:
         
-        logger.info('Crop to the clone map with lower left corner (x,y): '+str(xULClone)+' , '+str(yULClone))
-        # crop to cloneMap:
-        #~ xIdxSta = int(np.where(f.variables['lon'][:] == xULClone + 0.5*cellsizeInput)[0])
-        minX    = min(abs(f.variables['lon'][:] - (xULClone + 0.5*cellsizeInput))) # ; print(minX)
-        xIdxSta = int(np.where(abs(f.variables['lon'][:] - (xULClone + 0.5*cellsizeInput)) == minX)[0])
-        xIdxEnd = int(math.ceil(xIdxSta + colsClone /(cellsizeInput/cellsizeClone)))
-        #~ yIdxSta = int(np.where(f.variables['lat'][:] == yULClone - 0.5*cellsizeInput)[0])
-        minY    = min(abs(f.variables['lat'][:] - (yULClone - 0.5*cellsizeInput))) # ; print(minY)
-        yIdxSta = int(np.where(abs(f.variables['lat'][:] - (yULClone - 0.5*cellsizeInput)) == minY)[0])
-        yIdxEnd = int(math.ceil(yIdxSta + rowsClone /(cellsizeInput/cellsizeClone)))
-        cropData = f.variables[varName][idx,yIdxSta:yIdxEnd,xIdxSta:xIdxEnd]
+        logger.info('Crop to the clone map with lower left corner (x,y): '+str(attributeClone['xUL'])+' , '+str(attributeClone['yUL']))
+        # crop to cloneMap (only the hyperslab covering the clone is read):
+        yIdxSta,yIdxEnd,xIdxSta,xIdxEnd = getNetCDFCropIndices(grid,attributeClone)
+        cropData = readNetCDFHyperslab(f.variables[varName],grid,idx,yIdxSta,yIdxEnd,xIdxSta,xIdxEnd)
 
-        logger.info('Resample: input cell size = '+str(float(cellsizeInput))+' ; output/clone cell size = '+str(float(cellsizeClone)))
-        factor = int(float(cellsizeInput)/float(cellsizeClone))
+        logger.info('Resample: input cell size = '+str(float(grid['cellsize']))+' ; output/clone cell size = '+str(float(attributeClone['cellsize'])))
+        factor = int(float(grid['cellsize'])/float(attributeClone['cellsize']))
+    else:
+        cropData = readNetCDFHyperslab(f.variables[varName],grid,idx)
     
     # convert to PCR object and close f
     if specificFillValue != None:
@@ -261,6 +335,7 @@ def netcdf2PCRobjClone(ncFile,varName,dateInput,\
     # PCRaster object
     return (outPCR)
 
+@withNetCDFLock
 def netcdf2PCRobjCloneWindDist(ncFile,varName,dateInput,useDoy = None,
                        cloneMapFileName=None):
     # EHS (02 SEP 2013): This is a special function made by Niko Wanders (for his DA framework).
@@ -270,7 +345,7 @@ def netcdf2PCRobjCloneWindDist(ncFile,varName,dateInput,useDoy = None,
     #     Only works if cellsizeClone <= cellsizeInput
     
     # Get netCDF file and variable name:
-    f = nc.Dataset(ncFile)
+    f = netcdfpool.get(ncFile)
     varName = str(varName)
 
     # date
@@ -326,11 +401,11 @@ def netcdf2PCRobjCloneWindDist(ncFile,varName,dateInput,useDoy = None,
     outPCR = pcr.numpy2pcr(pcr.Scalar, \
                regridData2FinerGrid(factor,cropData,MV), \
                   float(0.0))
-    f.close();
     f = None ; cropData = None 
     # PCRaster object
     return (outPCR)    
     
+@withNetCDFLock
 def netcdf2PCRobjCloneWind(ncFile,varName,dateInput,useDoy = None,
                        cloneMapFileName=None):
     # EHS (02 SEP 2013): This is a special function made by Niko Wanders (for his DA framework).
@@ -340,7 +415,7 @@ def netcdf2PCRobjCloneWind(ncFile,varName,dateInput,useDoy = None,
     #     Only works if cellsizeClone <= cellsizeInput
     
     # Get netCDF file and variable name:
-    f = nc.Dataset(ncFile)
+    f = netcdfpool.get(ncFile)
     varName = str(varName)
 
     # date
@@ -395,17 +470,17 @@ def netcdf2PCRobjCloneWind(ncFile,varName,dateInput,useDoy = None,
     outPCR = pcr.numpy2pcr(pcr.Scalar, \
                regridData2FinerGrid(factor,cropData,MV), \
                   float(f.variables[varName]._FillValue))
-    f.close();
     f = None ; cropData = None 
     # PCRaster object
     return (outPCR)    
     
+@withNetCDFLock
 def netcdf2PCRobj(ncFile,varName,dateInput):
     # EHS (04 APR 2013): To convert netCDF (tss) file to PCR file.
     # The cloneMap is globally defined (outside this method).
     
     # Get netCDF file and variable name:
-    f = nc.Dataset(ncFile)
+    f = netcdfpool.get(ncFile)
     varName = str(varName)
 
     # date
@@ -422,7 +497,7 @@ def netcdf2PCRobj(ncFile,varName,dateInput):
     # convert to PCR object and close f
     outPCR = pcr.numpy2pcr(pcr.Scalar,(f.variables[varName][idx].data), \
                              float(f.variables[varName]._FillValue))
-    f.close(); f = None ; del f
+    f = None ; del f
     # PCRaster object
     return (outPCR)
 
@@ -636,45 +711,63 @@ def isLastDayOfMonth(date):
     else:
         return False
 
-def getMapAttributesALL(cloneMap):
+# cache of the attributes of PCRaster maps (key: file name, value: (modification time, attributes))
+mapattrcache = dict()
+
+def readMapHeader(mapFileName):
+    # Read the attributes of a PCRaster (CSF) map directly from its header, instead of calling mapattr.
+    # Returns None if the file is not a CSF map.
+    with open(mapFileName, 'rb') as f:
+        header = f.read(256)
+    if len(header) < 132 or header[0:27] != b"RUU CROSS SYSTEM MAP FORMAT":
+        return None
+    # byte order: the value 1 is stored at offset 46
+    byteOrder = '<' if struct.unpack('<I', header[46:50])[0] == 1 else '>'
+    # raster header (starting at offset 64)
+    xUL, yUL   = struct.unpack(byteOrder+'dd', header[84:100])
+    rows, cols = struct.unpack(byteOrder+'II', header[100:108])
+    cellsize   = struct.unpack(byteOrder+'d' , header[108:116])[0]
+    return {'cellsize': float(cellsize), 'rows': float(rows), 'cols': float(cols), 'xUL': float(xUL), 'yUL': float(yUL)}
+
+def getMapAttributesWithMapattr(cloneMap):
     co = ['mapattr -p %s ' %(cloneMap)]
     cOut,err = subprocess.Popen(co, stdout=subprocess.PIPE,stderr=open('/dev/null'),shell=True).communicate()
     if err !=None or cOut == []:
-        print "Something wrong with mattattr in virtualOS, maybe clone Map does not exist ? "
+        print("Something wrong with mattattr in virtualOS, maybe clone Map does not exist ? ")
         sys.exit()
     mapAttr = {'cellsize': float(cOut.split()[7]) ,\
                'rows'    : float(cOut.split()[3]) ,\
                'cols'    : float(cOut.split()[5]) ,\
                'xUL'     : float(cOut.split()[17]),\
                'yUL'     : float(cOut.split()[19])}
-    co = None; cOut = None; err = None
-    del co; del cOut; del err
-    n = gc.collect() ; del gc.garbage[:] ; n = None ; del n
-    return mapAttr 
+    return mapAttr
 
-def getMapAttributes(cloneMap,attribute):
-    co = ['mapattr -p %s ' %(cloneMap)]
-    cOut,err = subprocess.Popen(co, stdout=subprocess.PIPE,stderr=open('/dev/null'),shell=True).communicate()
-    #print cOut
-    if err !=None or cOut == []:
-        print "Something wrong with mattattr in virtualOS, maybe clone Map does not exist ? "
+def getMapAttributesALL(cloneMap):
+    # attributes are cached per file name and modification time
+    try:
+        modificationTime = os.path.getmtime(cloneMap)
+    except OSError:
+        print("Something wrong with mattattr in virtualOS, maybe clone Map does not exist ? ")
         sys.exit()
-    #print cOut.split()
-    co = None; err = None
-    del co; del err
-    n = gc.collect() ; del gc.garbage[:] ; n = None ; del n
+    if cloneMap in mapattrcache and mapattrcache[cloneMap][0] == modificationTime:
+        return dict(mapattrcache[cloneMap][1])
+    mapAttr = readMapHeader(cloneMap)
+    if mapAttr == None: mapAttr = getMapAttributesWithMapattr(cloneMap)
+    mapattrcache[cloneMap] = (modificationTime, mapAttr)
+    return dict(mapAttr)
+
+def getMapAttributes(cloneMap,attribute):
+    mapAttr = getMapAttributesALL(cloneMap)
     if attribute == 'cellsize':
-        return float(cOut.split()[7])
+        return mapAttr['cellsize']
     if attribute == 'rows':
-        return int(cOut.split()[3])
-        #return float(cOut.split()[3])
+        return int(mapAttr['rows'])
     if attribute == 'cols':
-        return int(cOut.split()[5])
-        #return float(cOut.split()[5])
+        return int(mapAttr['cols'])
     if attribute == 'xUL':
-        return float(cOut.split()[17])
+        return mapAttr['xUL']
     if attribute == 'yUL':
-        return float(cOut.split()[19])
+        return mapAttr['yUL']
     
 def getMapTotal(mapFile):
     ''' outputs the sum of all values in a map file '''
@@ -784,59 +877,102 @@ def regridData2FinerGrid(rescaleFac,coarse,MV=MV):
     if rescaleFac ==1:
         return coarse
     nr,nc = np.shape(coarse)
-    
-    fine= np.zeros(nr*nc*rescaleFac*rescaleFac).reshape(nr*rescaleFac,nc*rescaleFac) + MV
-    
- 
-    ii = -1
-    nrF,ncF = np.shape(fine)
-    for i in range(0 , nrF):
-            if i % rescaleFac == 0:
-                ii += 1
-            fine [i,:] = coarse[ii,:].repeat(rescaleFac)
-
-    nr = None; nc = None
-    del nr; del nc
-    nrF = None; ncF = None
-    del nrF; del ncF
-    n = gc.collect() ; del gc.garbage[:] ; n = None ; del n
-    return fine
+    # every coarse cell repeated to rescaleFac x rescaleFac cells: a broadcast view of the (unmasked) data, 
+    # copied once (in the input data type) by the reshape
+    data = np.ma.getdata(coarse)
+    return np.broadcast_to(data[:,None,:,None], (nr,rescaleFac,nc,rescaleFac)).reshape(nr*rescaleFac,nc*rescaleFac)
+
+def regridBlock(ar,mode,missValue=MV):
+    # statistics (mode) of a block, ignoring missValue
+    m = np.ma.masked_values(ar,missValue)
+    if ma.count(m) == 0:
+        return MV
+    if mode == 'average':
+        return ma.average(m)
+    elif mode == 'median': 
+        return ma.median(m)
+    elif mode == 'sum':
+        return ma.sum(m)
+    elif mode =='min':
+        return ma.min(m)
+    elif mode == 'max':
+        return ma.max(m)
+    elif mode == 'std':
+        return ma.std(m)
+    return MV
+
+def regridWindows(windows,mode,missValue=MV):
+    # statistics (mode) of windows (rows x cols x cells), ignoring missValue, with the same arithmetic 
+    # (summation order and type promotion) as regridBlock for the individual windows: 
+    # windows without missing values follow the ndarray functions, the other windows the masked array functions
+    m = np.ma.masked_values(windows,missValue,shrink=False)
+    count = ma.count(m, axis = -1)
+    full = count == windows.shape[-1]
+    if mode in ['average','std']:
+        total = ma.sum(m, axis = -1).filled(0)
+        # type of the average of a block with missing values (sum * 1. / count in MaskedArray.mean)
+        scalarType = np.asarray(ma.average(np.ma.masked_values(np.array([0, missValue], dtype = windows.dtype), missValue))).dtype
+        # (the ndarray functions are evaluated for all windows; for windows with missValue, their results, e.g. an
+        # overflow of the squared missValue in float32, are not used)
+        with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+            if mode == 'average':
+                values = np.where(full, np.mean(windows, axis = -1), \
+                                  total.astype(scalarType) * 1. / count.astype(scalarType))
+            else:
+                mean = total * 1. / count
+                deviation = np.where(m.mask, 0.0, windows - mean[...,None])
+                deviation *= deviation
+                values = np.where(full, np.std(windows, axis = -1), np.sqrt(deviation.sum(axis = -1) / count))
+    elif mode == 'median':
+        values = ma.median(m, axis = -1).filled(0)
+    elif mode == 'sum':
+        values = ma.sum(m, axis = -1).filled(0)
+    elif mode =='min':
+        values = ma.min(m, axis = -1).filled(0)
+    elif mode == 'max':
+        values = ma.max(m, axis = -1).filled(0)
+    else:
+        values = np.zeros(count.shape) + MV
+    values = np.array(values, dtype = np.float64)
+    values[count == 0] = MV
+    return values
 
 def regridToCoarse(fine,fac,mode,missValue=MV,window_extension=0):
+    # Statistics (mode) of the blocks of fac x fac cells of fine, extended by window_extension cells at every side
+    # and clipped at the edges of fine. Rows and columns beyond the last complete block are only used by the
+    # window extensions. The windows that are not clipped are strided views of fine, reduced at once per chunk
+    # of coarse rows; the clipped windows (at the edges) are reduced one by one.
+    fac = int(round(fac))
+    ext = int(window_extension)
+    fine = np.asarray(fine)
     nr,nc = np.shape(fine)
-    coarse = np.zeros(nr/fac * nc / fac).reshape(nr/fac,nc/fac) + MV
-    nr,nc = np.shape(coarse)
-    for r in range(0,nr):
-        for c in range(0,nc):
-
-            ar = fine[r * fac : fac * (r+1),c * fac: fac * (c+1)]
-            
-            if window_extension > 0: 
-                
-                min_r = max(0, r * fac - window_extension)
-                min_c = max(0, c * fac - window_extension)
-                
-                max_r = min(fac *(r+1) + window_extension, np.shape(fine)[0])
-                max_c = min(fac *(c+1) + window_extension, np.shape(fine)[1])
-                
-                ar = fine[min_r:max_r,min_c:max_c]
-            
-            m = np.ma.masked_values(ar,missValue)
-            if ma.count(m) == 0:
-                coarse[r,c] = MV
-            else:
-                if mode == 'average':
-                    coarse [r,c] = ma.average(m)
-                elif mode == 'median': 
-                    coarse [r,c] = ma.median(m)
-                elif mode == 'sum':
-                    coarse [r,c] = ma.sum(m)
-                elif mode =='min':
-                    coarse [r,c] = ma.min(m)
-                elif mode == 'max':
-                    coarse [r,c] = ma.max(m)
-                elif mode == 'std':
-                    coarse [r,c] = ma.std(m)
+    coarse = np.zeros((nr // fac, nc // fac)) + MV
+    nrC,ncC = np.shape(coarse)
+    size = fac + 2 * ext
+    
+    # coarse rows/columns of the windows that are not clipped 
+    r0,r1 = min(nrC, -(-ext // fac)), max(0, min(nrC, (nr - ext) // fac))
+    c0,c1 = min(ncC, -(-ext // fac)), max(0, min(ncC, (nc - ext) // fac))
+    if r1 > r0 and c1 > c0:
+        view = fine[r0 * fac - ext:, c0 * fac - ext:]
+        s0,s1 = view.strides
+        windows = np.lib.stride_tricks.as_strided(view, shape = (r1 - r0, c1 - c0, size, size), \
+                                                  strides = (fac * s0, fac * s1, s0, s1))
+        # per chunk of coarse rows, to limit the memory use of the window copies
+        chunk = max(1, 10000000 // ((c1 - c0) * size * size))
+        for first in range(0, r1 - r0, chunk):
+            block = windows[first:first + chunk].reshape(-1, c1 - c0, size * size)
+            coarse[r0 + first:r0 + first + block.shape[0], c0:c1] = regridWindows(block, mode, missValue)
+    
+    # clipped windows
+    for r in range(0,nrC):
+        for c in range(0,ncC):
+            if r0 <= r < r1 and c0 <= c < c1: continue
+            min_r = max(0, r * fac - ext)
+            min_c = max(0, c * fac - ext)
+            max_r = min(fac *(r+1) + ext, nr)
+            max_c = min(fac *(c+1) + ext, nc)
+            coarse[r,c] = regridBlock(fine[min_r:max_r,min_c:max_c], mode, missValue)
     return coarse    
         
     
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Window average (as pcr.windowaverage) computed from summed-area tables (integral images) of the values and
+# of the valid (non missing value) cells, so that the costs per cell do not depend on the window length.
+#
+# Semantics of pcr.windowaverage:
+# - the window is a square with sides of window_length (map units), centred on the cell;
+# - cells that are partly in the window are weighted by the fraction of the cell that is in the window;
+# - cells with a missing value, and cells outside the map, are ignored;
+# - the result is a missing value only if the window does not contain any cell with a value.
+
+import numpy as np
+
+import pcraster as pcr
+
+import logging
+logger = logging.getLogger(__name__)
+
+import virtualOS as vos
+
+def window_weights(window_length, cell_size):
+
+    # the window, in cells, as a weighted combination of boxes: [(half width, weight), ...]
+    # - cells at a distance <= m (cells) from the centre are completely in the window,
+    # - cells at a distance of m + 1 are in the window for a fraction f.
+    length = round(float(window_length) / cell_size, 6)
+    m = int(np.floor((length - 1.0) / 2.0))
+    f = (length - 1.0) / 2.0 - m
+    if m < 0: return [(0, length)]
+    if f == 0.0: return [(m, 1.0)]
+    return [(m, 1.0 - f), (m + 1, f)]
+
+def summed_area_table(values):
+
+    # prefix sums with a leading row and column of zeros
+    table = np.zeros((values.shape[0] + 1, values.shape[1] + 1))
+    np.cumsum(values, axis = 0, out = table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis = 1, out = table[1:, 1:])
+    return table
+
+def box_bounds(length, half_width):
+
+    # first and last + 1 index of the box around every index, clipped at the map edges
+    return np.clip(np.arange(length) - half_width, 0, length), np.clip(np.arange(length) + half_width + 1, 0, length)
+
+def box_sum(table, half_height, half_width, out = None):
+
+    # sum of the box (2 * half_height + 1 rows, 2 * half_width + 1 columns) around every cell, clipped at the map edges
+    nr_rows, nr_cols = table.shape[0] - 1, table.shape[1] - 1
+    top , bottom = box_bounds(nr_rows, half_height)
+    left, right  = box_bounds(nr_cols, half_width)
+    if out is None: out = np.empty((nr_rows, nr_cols))
+    np.subtract(table[np.ix_(bottom, right)], table[np.ix_(top, right)], out = out)
+    out -= table[np.ix_(bottom, left)]
+    out += table[np.ix_(top, left)]
+    return out
+
+def window_sum(table, window_length, cell_size, out = None):
+
+    # weighted sum of the window around every cell; a product of 1D weights gives the 2D weights
+    weights = window_weights(window_length, cell_size)
+    if out is None: out = np.empty((table.shape[0] - 1, table.shape[1] - 1))
+    out[...] = 0.0
+    box = np.empty(out.shape)
+    for half_height, row_weight in weights:
+        for half_width, col_weight in weights:
+            out += row_weight * col_weight * box_sum(table, half_height, half_width, out = box)
+    return out
+
+def window_area(shape, window_length, cell_size, out = None):
+
+    # weighted number of cells of the window around every cell that are in the map
+    weights = window_weights(window_length, cell_size)
+    if out is None: out = np.empty(shape)
+    out[...] = 0.0
+    for half_height, row_weight in weights:
+        top, bottom = box_bounds(shape[0], half_height)
+        for half_width, col_weight in weights:
+            left, right = box_bounds(shape[1], half_width)
+            out += row_weight * col_weight * np.outer(bottom - top, right - left)
+    return out
+
+def window_average(values, window_length, cell_size):
+
+    # values: 2D array with NaN as missing value ; returns a 2D array with NaN as missing value
+    # (the values are centred on their mean, to limit the rounding errors of the prefix sums)
+    valid = np.isfinite(values)
+    offset = values[valid].mean() if valid.any() else 0.0
+    value_sum = window_sum(summed_area_table(np.where(valid, values - offset, 0.0)), window_length, cell_size)
+    count_sum = window_sum(summed_area_table(valid.astype(np.float64)), window_length, cell_size)
+
+    # a small tolerance for the rounding errors of the prefix sums
+    defined = count_sum > 1e-9
+    average = np.empty(values.shape) + np.nan
+    average[defined] = value_sum[defined] / count_sum[defined] + offset
+    return average
+
+def windowaverage(pcr_map, window_length):
+
+    # replacement of pcr.windowaverage(pcr_map, window_length)
+    values = pcr.pcr2numpy(pcr.scalar(pcr_map), np.nan)
+    average = window_average(values, window_length, pcr.clone().cellSize())
+    return pcr.numpy2pcr(pcr.Scalar, np.where(np.isnan(average), vos.MV, average), vos.MV)
+
+def window_filling(values, values_without_MV, windows, cell_size, out = None):
+
+    # Filling of the missing values of "values" (as MargatCorrection.mapFilling with pcr.windowaverage):
+    # - interpolated values: sum of weight * window average of values, for all (window_length, weight) in windows,
+    # - weight factor      : sum of weight * fraction of the window (in the map) with values, clamped to [0, 1],
+    # - cells with a missing value get: weight factor * interpolated value + (1 - weight factor) * values_without_MV,
+    #   or values_without_MV if the interpolated value is missing.
+    # All windows use the same summed-area tables; the results are accumulated in a fixed number of buffers.
+    valid = np.isfinite(values)
+    offset = values[valid].mean() if valid.any() else 0.0
+    value_table = summed_area_table(np.where(valid, values - offset, 0.0))
+    count_table = summed_area_table(valid.astype(np.float64))
+
+    value_sum    = np.empty(values.shape)
+    count_sum    = np.empty(values.shape)
+    area         = np.empty(values.shape)
+    interpolated = np.zeros(values.shape)
+    weight       = np.zeros(values.shape)
+    for window_length, window_weight in windows:
+        window_sum(value_table, window_length, cell_size, out = value_sum)
+        window_sum(count_table, window_length, cell_size, out = count_sum)
+        window_area(values.shape, window_length, cell_size, out = area)
+        # the interpolated value is missing if one of the window averages is missing (as for PCRaster map algebra)
+        count_sum[count_sum <= 1e-9] = np.nan
+        value_sum /= count_sum
+        value_sum += offset
+        interpolated += window_weight * value_sum
+        count_sum /= area
+        weight += window_weight * np.nan_to_num(count_sum)
+    del value_table, count_table, value_sum, count_sum, area
+    np.clip(weight, 0.0, 1.0, out = weight)
+
+    # merge with the weight factor, retain the original values and make sure that all values are covered
+    if out is None: out = np.empty(values.shape)
+    np.multiply(weight, interpolated, out = out)
+    weight -= 1.0
+    weight *= values_without_MV
+    out -= weight
+    missing = np.isnan(out)
+    out[missing] = values_without_MV[missing]
+    out[valid] = values[valid]
+    return out
+
+def windowfilling(map_with_MV, map_without_MV, windows):
+
+    # PCRaster maps as input and output of window_filling
+    values            = pcr.pcr2numpy(pcr.scalar(map_with_MV)   , np.nan)
+    values_without_MV = pcr.pcr2numpy(pcr.scalar(map_without_MV), np.nan)
+    filled = window_filling(values, values_without_MV, windows, pcr.clone().cellSize())
+    filled[np.isnan(filled)] = vos.MV
+    return pcr.numpy2pcr(pcr.Scalar, filled, vos.MV)